@@ -8,6 +8,7 @@ typedef struct {
 	snd_seq_t *handle;
 	int client_id;
         PyObject * event_classes;
+        unsigned long input_overflows;
 } SeqClient;
 
 typedef struct {
@@ -47,6 +48,7 @@ SeqClient_new(PyTypeObject *type, PyObject *args, PyObject *kwds)
 
     self = (SeqClient *)type->tp_alloc(type, 0);
     self->handle = 0;
+    self->input_overflows = 0;
     return (PyObject *)self;
 }
 
@@ -258,6 +260,33 @@ SeqClient_continue_queue(SeqClient *self, PyObject *args, PyObject *kwds)
     return SeqClient_control_queue(self, args, kwds, SND_SEQ_EVENT_CONTINUE);
 }
 
+PyObject *
+SeqClient_get_queue_time(SeqClient *self, PyObject *args, PyObject *kwds)
+{
+    static char *kwlist[] = {"queue", NULL};
+    int queue = 0;
+
+    if (! PyArg_ParseTupleAndKeywords(args, kwds, "i", kwlist, &queue))
+        return NULL;
+
+    if (!self->handle) {
+        PyErr_SetString(SeqError, "already closed");
+        return NULL;
+    }
+
+    snd_seq_queue_status_t *status;
+    snd_seq_queue_status_alloca(&status);
+    int err = snd_seq_get_queue_status(self->handle, queue, status);
+    if (err < 0) {
+        return set_error(-err);
+    }
+
+    const snd_seq_real_time_t *rt = snd_seq_queue_status_get_real_time(status);
+    return Py_BuildValue("(kII)",
+                         (unsigned long)snd_seq_queue_status_get_tick_time(status),
+                         rt->tv_sec, rt->tv_nsec);
+}
+
 PyObject *
 SeqClient_event_output(SeqClient *self, PyObject *args, PyObject *kwds)
 {
@@ -381,6 +410,115 @@ SeqClient_event_output(SeqClient *self, PyObject *args, PyObject *kwds)
     return PyLong_FromLong(err);
 }
 
+PyObject *
+SeqClient_event_output_many(SeqClient *self, PyObject *args, PyObject *kwds)
+{
+    static char *kwlist[] = {"events", "port", "queue", "drain",
+                             "realtime", "relative", NULL};
+    PyObject* events_o = NULL;
+    PyObject* port_o = NULL;
+    PyObject* queue_o = NULL;
+    PyObject* rt_sec_o = NULL, * rt_nsec_o = NULL;
+    int drain = 1;
+    int relative = 0;
+    long port = -1, queue = -1;
+    unsigned long rt_sec = 0, rt_nsec = 0;
+
+    if (! PyArg_ParseTupleAndKeywords(args, kwds, "O|OOp(OO)p", kwlist,
+                                      &events_o, &port_o, &queue_o, &drain,
+                                      &rt_sec_o, &rt_nsec_o, &relative))
+        return NULL;
+
+    if (!self->handle) {
+        PyErr_SetString(SeqError, "already closed");
+        return NULL;
+    }
+
+    if (port_o && port_o != Py_None) {
+        port = PyLong_AsLong(port_o);
+        if (PyErr_Occurred()) return NULL;
+        if (port < 0 || port > 255) {
+            PyErr_SetString(PyExc_ValueError, "Invalid port number");
+            return NULL;
+        }
+    }
+
+    if (queue_o && queue_o != Py_None) {
+        queue = PyLong_AsLong(queue_o);
+        if (PyErr_Occurred()) return NULL;
+        if (queue < 0 || queue > 255) {
+            PyErr_SetString(PyExc_ValueError, "Invalid queue number");
+            return NULL;
+        }
+    }
+
+    if (rt_sec_o && rt_nsec_o) {
+        if (queue < 0) {
+            PyErr_SetString(PyExc_ValueError, "'realtime' schedule needs a queue");
+            return NULL;
+        }
+        rt_sec = PyLong_AsUnsignedLong(rt_sec_o);
+        if (PyErr_Occurred()) return NULL;
+        rt_nsec = PyLong_AsUnsignedLong(rt_nsec_o);
+        if (PyErr_Occurred()) return NULL;
+    }
+
+    PyObject* iter = PyObject_GetIter(events_o);
+    if (!iter) return NULL;
+
+    long count = 0;
+    PyObject* item;
+    snd_seq_event_t ev;
+    while ((item = PyIter_Next(iter))) {
+        if (!PyObject_TypeCheck(item, &SeqEventType)) {
+            Py_DECREF(item);
+            Py_DECREF(iter);
+            PyErr_SetString(PyExc_TypeError, "SeqEvent expected");
+            return NULL;
+        }
+        // make a copy, as modifying event here would be unexpected
+        ev = ((SeqEvent *)item)->ev;
+        Py_DECREF(item);
+
+        if (port >= 0) {
+            snd_seq_ev_set_source(&ev, port);
+        }
+        if (queue >= 0) {
+            ev.queue = queue;
+        }
+        if (rt_sec_o) {
+            ev.flags &= ~(SND_SEQ_TIME_STAMP_MASK | SND_SEQ_TIME_MODE_MASK);
+            ev.flags |= SND_SEQ_TIME_STAMP_REAL;
+            ev.flags |= relative ? SND_SEQ_TIME_MODE_REL : SND_SEQ_TIME_MODE_ABS;
+            ev.time.time.tv_sec = rt_sec;
+            ev.time.time.tv_nsec = rt_nsec;
+        }
+        if (ev.type == SND_SEQ_EVENT_NOTE && ev.queue == SND_SEQ_QUEUE_DIRECT) {
+            Py_DECREF(iter);
+            PyErr_SetString(PyExc_ValueError, "Note events must be enqueued");
+            return NULL;
+        }
+
+        int err = snd_seq_event_output(self->handle, &ev);
+        if (err < 0) {
+            Py_DECREF(iter);
+            return set_error(-err);
+        }
+        count++;
+    }
+    Py_DECREF(iter);
+    if (PyErr_Occurred()) return NULL;
+
+    if (drain && count) {
+        int err = snd_seq_drain_output(self->handle);
+        if (err < 0) {
+            return set_error(-err);
+        }
+    }
+
+    return PyLong_FromLong(count);
+}
+
 
 PyObject *
 SeqClient_drain_output(SeqClient *self)
@@ -574,21 +712,9 @@ SeqClient_fileno(SeqClient *self)
     return PyLong_FromLong(pfd.fd);
 }
 
-PyObject *
-SeqClient_event_input(SeqClient *self)
+static PyObject *
+SeqClient_make_event(SeqClient *self, snd_seq_event_t *ev)
 {
-    if (!self->handle) {
-        PyErr_SetString(SeqError, "already closed");
-        return NULL;
-    }
-
-    snd_seq_event_t *ev;
-
-    int res = snd_seq_event_input(self->handle, &ev);
-    if (res < 0) {
-        return set_error(-res);
-    }
-
     PyObject * key = PyLong_FromLong(ev->type);
     PyObject * e_type = PyDict_GetItem(self->event_classes, key);
     Py_CLEAR(key);
@@ -619,6 +745,85 @@ SeqClient_event_input(SeqClient *self)
     return (PyObject *)event;
 }
 
+PyObject *
+SeqClient_event_input(SeqClient *self)
+{
+    if (!self->handle) {
+        PyErr_SetString(SeqError, "already closed");
+        return NULL;
+    }
+
+    snd_seq_event_t *ev;
+
+    int res = snd_seq_event_input(self->handle, &ev);
+    if (res < 0) {
+        return set_error(-res);
+    }
+
+    return SeqClient_make_event(self, ev);
+}
+
+PyObject *
+SeqClient_event_input_batch(SeqClient *self, PyObject *args, PyObject *kwds)
+{
+    static char *kwlist[] = {"max_events", NULL};
+    int max_events = 0;
+
+    if (! PyArg_ParseTupleAndKeywords(args, kwds, "|i", kwlist, &max_events))
+        return NULL;
+
+    if (!self->handle) {
+        PyErr_SetString(SeqError, "already closed");
+        return NULL;
+    }
+
+    PyObject* result = PyList_New(0);
+    if (!result) return NULL;
+
+    snd_seq_event_t *ev;
+    int count = 0;
+    while (max_events <= 0 || count < max_events) {
+        // fetches more from the sequencer only when the buffer is empty
+        int res = snd_seq_event_input_pending(self->handle, 1);
+        if (res == 0) {
+            break;
+        }
+        else if (res > 0) {
+            res = snd_seq_event_input(self->handle, &ev);
+        }
+        if (res == -EAGAIN) {
+            break;
+        }
+        else if (res == -ENOSPC) {
+            // input queue overflow, events lost
+            self->input_overflows++;
+            continue;
+        }
+        else if (res == -EINTR) {
+            continue;
+        }
+        else if (res < 0) {
+            Py_DECREF(result);
+            return set_error(-res);
+        }
+
+        PyObject* event = SeqClient_make_event(self, ev);
+        if (!event) {
+            Py_DECREF(result);
+            return NULL;
+        }
+        if (PyList_Append(result, event) < 0) {
+            Py_DECREF(event);
+            Py_DECREF(result);
+            return NULL;
+        }
+        Py_DECREF(event);
+        count++;
+    }
+
+    return result;
+}
+
 PyObject *
 SeqClient_event_input_pending(SeqClient *self, PyObject *args, PyObject *kwds)
 {
@@ -718,9 +923,15 @@ static PyMethodDef SeqClient_methods[] = {
     {"continue_queue", (PyCFunction)SeqClient_continue_queue, METH_VARARGS | METH_KEYWORDS,
              "Continue queue",
     },
+    {"get_queue_time", (PyCFunction)SeqClient_get_queue_time, METH_VARARGS | METH_KEYWORDS,
+             "Get current queue time as (tick, seconds, nanoseconds) tuple",
+    },
     {"event_output", (PyCFunction)SeqClient_event_output, METH_VARARGS | METH_KEYWORDS,
              "Output an event",
     },
+    {"event_output_many", (PyCFunction)SeqClient_event_output_many, METH_VARARGS | METH_KEYWORDS,
+             "Output a sequence of events and drain the output buffer once",
+    },
     {"drain_output", (PyCFunction)SeqClient_drain_output, METH_NOARGS,
              "Drop pending output events",
     },
@@ -748,6 +959,9 @@ static PyMethodDef SeqClient_methods[] = {
     {"event_input", (PyCFunction)SeqClient_event_input, METH_NOARGS,
              "Get input event",
     },
+    {"event_input_batch", (PyCFunction)SeqClient_event_input_batch, METH_VARARGS | METH_KEYWORDS,
+             "Get all pending input events (up to max_events) as a list",
+    },
     {"event_input_pending", (PyCFunction)SeqClient_event_input_pending, METH_VARARGS | METH_KEYWORDS,
              "Get length of pending input events",
     },
@@ -760,6 +974,7 @@ static PyMethodDef SeqClient_methods[] = {
 static PyMemberDef SeqClient_members[] = {
     {"client_id", T_INT, offsetof(SeqClient, client_id), 0, "client id"},
     {"event_classes", T_OBJECT, offsetof(SeqClient, event_classes), READONLY, "mapping of event id to event class"},
+    {"input_overflows", T_ULONG, offsetof(SeqClient, input_overflows), READONLY, "number of input queue overflows seen by event_input_batch()"},
     {NULL}  /* Sentinel */
 };
 
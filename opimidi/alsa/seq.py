@@ -1,6 +1,5 @@
 
 import logging
-import errno
 
 from functools import partial
 
@@ -9,6 +8,8 @@ from ._seq import *
 
 logger = logging.getLogger("alsa.seq")
 
+INPUT_BATCH_SIZE = 64
+
 class Client(_seq.SeqClient):
     __slots__ = ()
     def __init__(self, *args, **kwargs):
@@ -21,21 +22,18 @@ class Client(_seq.SeqClient):
     def _incoming(self, callback):
         logger.debug("   input pending")
         while True:
-            try:
-                event = self.event_input()
-            except OSError as err:
-                if err.errno == errno.ENOSPC:
-                    logger.warning("Input queue overflow, events lost")
-                elif err.errno == errno.EAGAIN:
-                    logger.debug("   no more events pending")
-                    break
-                elif err.errno == errno.EINTR:
-                    logger.debug("   EINTR")
-                    continue
-                else:
-                    raise
-            logger.debug("   got event: %r:", event)
-            callback(event)
+            overflows = self.input_overflows
+            events = self.event_input_batch(INPUT_BATCH_SIZE)
+            if self.input_overflows != overflows:
+                logger.warning("Input queue overflow, events lost")
+            for event in events:
+                logger.debug("   got event: %r:", event)
+                callback(event)
+            if len(events) < INPUT_BATCH_SIZE:
+                # events left in the library buffer would not wake us up
+                # again, so only stop when the batch was not full
+                logger.debug("   no more events pending")
+                break
 
 class SeqEvent(_seq.SeqEvent):
     __slots__ = ()
@@ -7,10 +7,15 @@ import os
 import signal
 import socket
 
+from evdev import ecodes
+
+from .alsa import seq
 from .comm import CommProtocol
 from .config import Config
-from .input import EventHandler, make_devices
+from .config_watcher import ConfigWatcher
+from .input import EventHandler, HwmonInput, make_devices
 from .midi_sender import MIDISender
+from .state_page import StatePageWriter
 from .util import abort, signal_handler
 
 logger = logging.getLogger("main")
@@ -22,15 +27,128 @@ BACKEND_SOCKET = os.path.join(SOCKET_DIR, "backend.socket")
 SD_LISTEN_FDS_START = 3
 
 class BackendEventHandler(EventHandler):
+    """Dispatch input events to the subscribed clients or the MIDI sender.
+
+    Clients subscribe to (type, code) pairs, code None meaning all
+    events of the type. Events a client subscribed to are not sent
+    as MIDI, unless the subscription is a 'tap'.
+
+    Absolute (pedal) events and the MIDI sent are published to the
+    clients with their update rate limits."""
     def __init__(self, midi_sender):
         self.midi_sender = midi_sender
+        # client -> (events, tap_events)
         self.subscribers = {}
+        # (type, code) -> [(client, tap), ...], filled as events come
+        self._index = {}
+        # clients receiving the MIDI output
+        self.midi_subscribers = set()
+        midi_sender.output_listeners.append(self.midi_sent)
+        # StatePageWriter to keep up to date, if any
+        self.state_page = None
+        # HwmonInput to get raw pedal values from
+        self.pedal_device = None
+        self.input_event_count = 0
+
+    def set_subscription(self, client, events, tap_events=()):
+        self.subscribers[client] = (frozenset(events), frozenset(tap_events))
+        self._index = {}
+
+    def remove_subscriber(self, client):
+        if self.subscribers.pop(client, None) is not None:
+            self._index = {}
+        self.midi_subscribers.discard(client)
+
+    def set_midi_subscription(self, client, enabled):
+        if not enabled:
+            self.midi_subscribers.discard(client)
+            return
+        self.midi_subscribers.add(client)
+        # current state first
+        for channel, param, value in self.midi_sender.controls.known_cc():
+            client.publish(("cc", channel, param),
+                           ["midi_cc", channel, param, value])
+
+    def config_reloaded(self, config):
+        """Use the new config and tell the clients about it."""
+        self.midi_sender.set_config(config)
+        clients = set(self.subscribers) | self.midi_subscribers
+        for client in clients:
+            client.send_frame([["config_reloaded"]])
+
+    def program_changed(self, bank_n, prog_n):
+        if self.state_page:
+            self.state_page.set_program(bank_n, prog_n)
+
+    def _update_state_page(self, events):
+        state_page = self.state_page
+        midi_sender = self.midi_sender
+        with state_page.update():
+            for event in events:
+                if event.type == seq.EVENT_CONTROLLER:
+                    state_page.set_cc(event.channel, event.param, event.value)
+            # the counters only, get_stats() also computes the timings
+            state_page.set_counters(input_events=self.input_event_count,
+                                    midi_sent=midi_sender.sent_count,
+                                    midi_suppressed=midi_sender.suppressed_count,
+                                    midi_coalesced=midi_sender.coalesced_count,
+                                    midi_late=midi_sender.late_count)
+
+    def midi_sent(self, events):
+        if self.state_page:
+            self._update_state_page(events)
+        if not self.midi_subscribers:
+            return
+        for event in events:
+            if event.type == seq.EVENT_CONTROLLER:
+                key = ("cc", event.channel, event.param)
+                command = ["midi_cc", event.channel, event.param, event.value]
+            elif event.type == seq.EVENT_PGMCHANGE:
+                key = ("program", event.channel)
+                command = ["midi_program", event.channel, event.value]
+            else:
+                continue
+            for client in self.midi_subscribers:
+                client.publish(key, command)
+
+    def _targets(self, key):
+        targets = []
+        wildcard = (key[0], None)
+        for client, (events, tap_events) in self.subscribers.items():
+            if key in events or wildcard in events:
+                targets.append((client, False))
+            elif key in tap_events or wildcard in tap_events:
+                targets.append((client, True))
+        logger.debug("Subscribers of %r: %r", key, targets)
+        self._index[key] = targets
+        return targets
+
     def handle_event(self, event):
+        self.input_event_count += 1
+        if self.state_page and event.type == ecodes.EV_ABS:
+            raw_value = -1
+            if self.pedal_device:
+                try:
+                    raw_value = self.pedal_device.values[event.code]
+                except IndexError:
+                    pass
+            self.state_page.set_pedal(event.code, raw_value, event.value)
+        key = (event.type, event.code)
+        targets = self._index.get(key)
+        if targets is None:
+            targets = self._targets(key)
         used = False
-        for client, subscriptions in self.subscribers.items():
-            if (event.type, event.code) in subscriptions:
-                client.send_frame([["input_event"] + list(event)])
-                used = True
+        if targets:
+            command = ["input_event"] + list(event)
+            # only the latest pedal position matters
+            coalesce = event.type == ecodes.EV_ABS
+            for client, tap in targets:
+                if coalesce:
+                    client.publish(key, command)
+                else:
+                    client.send_frame([command])
+                if not tap:
+                    used = True
         if not used:
             self.midi_sender.handle_event(event)
 
@@ -39,21 +157,67 @@ class BackendProtocol(CommProtocol):
         self.event_handler = event_handler
         self.midi_sender = event_handler.midi_sender
         CommProtocol.__init__(self, loop)
+        # max updates per second sent by publish(), 0: no limit
+        self.max_update_rate = 0
+        # key -> time of the last update sent
+        self._update_times = {}
+        # key -> latest command to be sent when allowed
+        self._pending_updates = {}
+
+    def cmd_set_update_rate(self, max_rate):
+        self.max_update_rate = max_rate
+        logger.debug("Client update rate limit: %r/s", max_rate)
+
+    def cmd_subscribe_midi(self, enabled=True):
+        self.event_handler.set_midi_subscription(self, enabled)
+
+    def publish(self, key, command):
+        """Send a value update, coalescing updates of the same `key` to
+        obey the client rate limit or while the client does not read."""
+        if not self.max_update_rate:
+            self.send_latest(key, command)
+            return
+        if key in self._pending_updates:
+            self._pending_updates[key] = command
+            return
+        now = self.loop.time()
+        last = self._update_times.get(key)
+        wait = 0
+        if last is not None:
+            wait = last + 1.0 / self.max_update_rate - now
+        if wait > 0:
+            self._pending_updates[key] = command
+            self.loop.call_later(wait, self._publish_pending, key)
+        else:
+            self._update_times[key] = now
+            self.send_latest(key, command)
 
-    def cmd_set_subscribed_events(self, events):
+    def _publish_pending(self, key):
+        command = self._pending_updates.pop(key, None)
+        if command is None or not self.transport:
+            return
+        self._update_times[key] = self.loop.time()
+        self.send_latest(key, command)
+
+    def cmd_set_subscribed_events(self, events, tap_events=()):
+        """Subscribe to [type, code] events, code None for all of a type.
+
+        `tap_events` are only observed, still sent as MIDI too."""
         events = set((t, v) for t, v in events)
-        self.event_handler.subscribers[self] = events
-        logger.debug("Event subscription changed: %r", events)
+        tap_events = set((t, v) for t, v in tap_events)
+        self.event_handler.set_subscription(self, events, tap_events)
+        logger.debug("Event subscription changed: %r, tap: %r",
+                     events, tap_events)
 
     def connection_lost(self, exc):
         super().connection_lost(exc)
-        try:
-            del self.event_handler.subscribers[self]
-        except KeyError:
-            pass
+        self.event_handler.remove_subscriber(self)
+        self._pending_updates = {}
+        self.transport = None
 
     def cmd_set_program(self, bank_n, prog_n):
         self.midi_sender.set_program(bank_n, prog_n)
+        self.event_handler.program_changed(bank_n, prog_n)
 
 def get_activation_socket():
     try:
@@ -91,6 +255,13 @@ def main():
         config = Config()
         midi_sender = MIDISender(config)
         event_handler = BackendEventHandler(midi_sender)
+        try:
+            event_handler.state_page = StatePageWriter()
+        except OSError as err:
+            logger.warning("Could not create the state page: %s", err)
+        config_watcher = ConfigWatcher(loop, config,
+                                       event_handler.config_reloaded)
+        config_watcher.start()
         logger.debug("Creating backend socket...")
         try:
             proto_f = partial(BackendProtocol, loop, event_handler)
@@ -105,16 +276,21 @@ def main():
             return
         try:
             jobs = []
-            for device in make_devices():
+            for device in make_devices(config):
+                if isinstance(device, HwmonInput):
+                    event_handler.pedal_device = device
                 jobs.append(device.collect_events(event_handler))
             loop.run_until_complete(asyncio.wait(jobs))
         finally:
+            config_watcher.close()
             server.close()
             try:
                 os.unlink(BACKEND_SOCKET)
             except OSError:
                 pass
             loop.run_until_complete(server.wait_closed())
+            if event_handler.state_page:
+                event_handler.state_page.close()
     except asyncio.CancelledError:
         loop.run_until_complete(asyncio.wait(asyncio.Task.all_tasks()))
     finally:
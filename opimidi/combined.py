@@ -0,0 +1,82 @@
+"""Back-end and front-end in a single process.
+
+For setups that do not need the two processes separated: the UI talks
+to the back-end through an in-process connection instead of the Unix
+socket, saving the memory of the second interpreter and the IPC.
+"""
+
+import argparse
+import asyncio
+import logging
+import signal
+
+from .backend import BackendEventHandler, BackendProtocol
+from .comm import connect_local
+from .config import Config
+from .config_watcher import ConfigWatcher
+from .frontend import FrontendProtocol
+from .input import HwmonInput, make_devices
+from .midi_sender import MIDISender
+from .state_page import StatePageWriter
+from .ui import OpimidiUI
+from .util import signal_handler
+
+logger = logging.getLogger("main")
+
+class LocalFrontendProtocol(FrontendProtocol):
+    """Front-end sharing the back-end config."""
+    def __init__(self, loop, midi_sender):
+        FrontendProtocol.__init__(self, loop)
+        self.midi_sender = midi_sender
+    def cmd_config_reloaded(self):
+        if self.ui:
+            self.ui.reload_config(self.midi_sender.config)
+
+def main():
+    parser = argparse.ArgumentParser(description="OPiMIDI (single process)")
+    parser.add_argument("--debug", dest="log_level",
+                        action="store_const", const=logging.DEBUG,
+                        help="Enable debug logging")
+    parser.set_defaults(log_level=logging.INFO)
+    args = parser.parse_args()
+    logging.basicConfig(level=args.log_level)
+
+    loop = asyncio.get_event_loop()
+    loop.add_signal_handler(signal.SIGINT, signal_handler, loop)
+    loop.add_signal_handler(signal.SIGTERM, signal_handler, loop)
+    try:
+        config = Config()
+        midi_sender = MIDISender(config)
+        event_handler = BackendEventHandler(midi_sender)
+        try:
+            event_handler.state_page = StatePageWriter()
+        except OSError as err:
+            logger.warning("Could not create the state page: %s", err)
+        backend = BackendProtocol(loop, event_handler)
+        frontend = LocalFrontendProtocol(loop, midi_sender)
+        transport, _ = connect_local(loop, frontend, backend)
+        config_watcher = ConfigWatcher(loop, config,
+                                       event_handler.config_reloaded)
+        config_watcher.start()
+        try:
+            ui = OpimidiUI(frontend, config)
+            jobs = []
+            for device in make_devices(config):
+                if isinstance(device, HwmonInput):
+                    event_handler.pedal_device = device
+                jobs.append(device.collect_events(event_handler))
+            jobs.append(ui.run())
+            loop.run_until_complete(asyncio.wait(jobs))
+        finally:
+            config_watcher.close()
+            transport.close()
+            if event_handler.state_page:
+                event_handler.state_page.close()
+    except asyncio.CancelledError:
+        loop.run_until_complete(asyncio.wait(asyncio.Task.all_tasks()))
+    finally:
+        logger.debug("Cleaning up...")
+        loop.close()
+
+if __name__ == "__main__":
+    main()
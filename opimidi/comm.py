@@ -2,39 +2,295 @@
 import asyncio
 import logging
 import json
+import os
+import struct
+
+from . import packing
 
 logger = logging.getLogger("comm")
 
+# Frames are lists of commands: [[command, arg1, arg2...], ...]
+#
+# JSON frames: JSON text terminated by NUL (the initial encoding)
+# binary frames: BINARY_MARK, uint32 payload length, payload of commands:
+#   CMD_PACKED, command list in packing (MessagePack) format
+#   CMD_INPUT_EVENT_INT/_FLOAT, input_event arguments as INPUT_EVENT_*
+# Both kinds are always accepted, the encoding negotiated with the
+# 'hello' and 'encoding' commands only selects what is sent.
+#
+# Protocols connected in-process with connect_local() pass the frames
+# as they are, without any encoding.
+
+BINARY_MARK = 0xb1
+BINARY_HEADER = struct.Struct("<BI")
+
+CMD_PACKED = 0x00
+CMD_INPUT_EVENT_INT = 0x01
+CMD_INPUT_EVENT_FLOAT = 0x02
+
+# timestamp, type, code, value, timedelta
+INPUT_EVENT_INT = struct.Struct("<dHHid")
+INPUT_EVENT_FLOAT = struct.Struct("<dHHdd")
+
+# larger frames are a protocol error, the connection is closed
+MAX_FRAME_SIZE = 1024 * 1024
+
+# transport write buffer size above which we stop writing, queue the
+# outgoing commands and only keep the latest value of keyed updates
+WRITE_BUFFER_HIGH = 16 * 1024
+# max other commands queued while the peer is not reading; a peer
+# staying above that for QUEUE_OVERFLOW_TIMEOUT seconds, or reaching
+# MAX_QUEUED_COMMANDS_HARD, is disconnected
+MAX_QUEUED_COMMANDS = 256
+MAX_QUEUED_COMMANDS_HARD = 1024
+QUEUE_OVERFLOW_TIMEOUT = 2.0
+
+# encodings we can send, by preference ($OPIMIDI_COMM_ENCODING=json
+# forces JSON, for debugging)
+ENCODINGS = ["binary", "json"]
+
+def _encodings():
+    forced = os.environ.get("OPIMIDI_COMM_ENCODING")
+    if forced:
+        return [forced]
+    return ENCODINGS
+
+def encode_json(frame):
+    return json.dumps(frame).encode("utf-8") + b"\x00"
+
+def encode_binary(frame):
+    out = bytearray(BINARY_HEADER.size)
+    for command in frame:
+        if command[0] == "input_event" and len(command) == 6:
+            if isinstance(command[4], int):
+                code, fmt = CMD_INPUT_EVENT_INT, INPUT_EVENT_INT
+            else:
+                code, fmt = CMD_INPUT_EVENT_FLOAT, INPUT_EVENT_FLOAT
+            try:
+                packed = fmt.pack(*command[1:])
+            except struct.error:
+                pass
+            else:
+                out.append(code)
+                out += packed
+                continue
+        out.append(CMD_PACKED)
+        packing.pack(command, out)
+    BINARY_HEADER.pack_into(out, 0, BINARY_MARK,
+                            len(out) - BINARY_HEADER.size)
+    return out
+
+def decode_binary(payload):
+    frame = []
+    offset = 0
+    length = len(payload)
+    while offset < length:
+        code = payload[offset]
+        offset += 1
+        if code == CMD_PACKED:
+            command, offset = packing.unpack_from(payload, offset)
+        elif code == CMD_INPUT_EVENT_INT:
+            command = ["input_event"]
+            command += INPUT_EVENT_INT.unpack_from(payload, offset)
+            offset += INPUT_EVENT_INT.size
+        elif code == CMD_INPUT_EVENT_FLOAT:
+            command = ["input_event"]
+            command += INPUT_EVENT_FLOAT.unpack_from(payload, offset)
+            offset += INPUT_EVENT_FLOAT.size
+        else:
+            raise ValueError("Unknown binary command code: {}".format(code))
+        frame.append(command)
+    return frame
+
+class LocalTransport(asyncio.Transport):
+    """Transport passing frames to a protocol in the same process."""
+    def __init__(self, loop, peer):
+        super().__init__()
+        self.loop = loop
+        self.peer = peer
+        self.protocol = None
+        self.peer_transport = None
+        self._closing = False
+
+    def write_frame(self, frame):
+        if not self._closing:
+            self.peer.frame_received(frame)
+
+    def write(self, data):
+        if not self._closing:
+            self.peer.data_received(bytes(data))
+
+    def is_closing(self):
+        return self._closing
+
+    def close(self):
+        if self._closing:
+            return
+        self._closing = True
+        self.loop.call_soon(self.protocol.connection_lost, None)
+        self.peer_transport.close()
+
+    abort = close
+
+    def get_extra_info(self, name, default=None):
+        if name == "peername":
+            return "local"
+        return default
+
+    def set_write_buffer_limits(self, high=None, low=None):
+        pass
+
+    def get_write_buffer_size(self):
+        return 0
+
+def connect_local(loop, protocol_a, protocol_b):
+    """Connect two protocols directly, return their transports."""
+    transport_a = LocalTransport(loop, protocol_b)
+    transport_b = LocalTransport(loop, protocol_a)
+    transport_a.protocol = protocol_a
+    transport_b.protocol = protocol_b
+    transport_a.peer_transport = transport_b
+    transport_b.peer_transport = transport_a
+    protocol_a.connection_made(transport_a)
+    protocol_b.connection_made(transport_b)
+    return transport_a, transport_b
+
 class CommProtocol(asyncio.Protocol):
     def __init__(self, loop):
         logger.debug('Creating CommProtocol')
         self.loop = loop
         self.transport = None
-        self._frame_buf = bytes()
+        self.encoding = "json"
+        # incomplete frame data
+        self._frame_buf = bytearray()
+        # how much of an incomplete JSON frame has been searched for the NUL
+        self._scan_pos = 0
+        # commands to send with the next write
+        self._out_queue = []
+        # key -> latest command, for updates queued while paused
+        self._latest = {}
+        self._flush_handle = None
+        self._overflow_handle = None
+        self._paused = False
+        self.dropped_count = 0
 
     def connection_made(self, transport):
         peername = transport.get_extra_info('peername')
         logger.debug('Connection with %s', peername)
         self.transport = transport
+        if isinstance(transport, LocalTransport):
+            self.encoding = "local"
+        transport.set_write_buffer_limits(high=WRITE_BUFFER_HIGH)
 
     def connection_lost(self, exc):
         logger.debug('Connection lost')
+        if self._flush_handle:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        self._cancel_overflow()
+        self._out_queue = []
+        self._latest = {}
+
+    def pause_writing(self):
+        logger.debug("Peer not reading, queueing frames")
+        self._paused = True
+
+    def resume_writing(self):
+        logger.debug("Peer reading again")
+        self._paused = False
+        self._cancel_overflow()
+        self.flush()
+
+    def negotiate_encoding(self):
+        """Offer the other side our encodings, to be called by the client."""
+        if self.encoding == "local":
+            return
+        self.send_frame([["hello", _encodings()]])
+
+    def cmd_hello(self, encodings):
+        ours = _encodings()
+        for encoding in encodings:
+            if encoding in ours:
+                break
+        else:
+            encoding = "json"
+        logger.debug("Using %r encoding", encoding)
+        self.send_frame([["encoding", encoding]])
+        self.encoding = encoding
+
+    def cmd_encoding(self, encoding):
+        if encoding not in ENCODINGS:
+            logger.warning("Unsupported encoding requested: %r", encoding)
+            return
+        logger.debug("Using %r encoding", encoding)
+        self.encoding = encoding
 
     def data_received(self, data):
-        message = data.decode()
-        logger.debug('Data received: %r', message)
-        while data:
-            if 0 in data:
-                head, data = data.split(b"\x00", 1)
-                frame = self._frame_buf + head
-                self._frame_buf = data
-                logger.debug("head: %r data: %r, frame: %r, frame_buf=%r",
-                        head, data, frame, self._frame_buf)
-                decoded = json.loads(frame.decode("utf-8"))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('Data received: %r', bytes(data))
+        buf = self._frame_buf
+        if not buf:
+            # common case: complete frames, parse them right from `data`
+            consumed = self._parse_frames(data)
+            if 0 <= consumed < len(data):
+                buf += memoryview(data)[consumed:]
+        else:
+            buf += data
+            consumed = self._parse_frames(buf)
+            if consumed > 0:
+                del buf[:consumed]
+        if consumed < 0 or len(buf) > MAX_FRAME_SIZE + BINARY_HEADER.size:
+            self._protocol_error("Frame too large")
+
+    def _parse_frames(self, data):
+        """Process complete frames in `data`, return bytes used.
+
+        -1 is returned for a frame too large."""
+        pos = 0
+        length = len(data)
+        scan = self._scan_pos
+        self._scan_pos = 0
+        with memoryview(data) as view:
+            while pos < length:
+                if data[pos] == BINARY_MARK:
+                    if length - pos < BINARY_HEADER.size:
+                        break
+                    _, size = BINARY_HEADER.unpack_from(data, pos)
+                    if size > MAX_FRAME_SIZE:
+                        return -1
+                    start = pos + BINARY_HEADER.size
+                    end = start + size
+                    if end > length:
+                        break
+                    pos = end
+                    scan = 0
+                    try:
+                        decoded = decode_binary(view[start:end])
+                    except (ValueError, struct.error) as err:
+                        logger.error("Invalid binary frame: %s", err)
+                        continue
+                else:
+                    end = data.find(b"\x00", pos + scan)
+                    if end < 0:
+                        self._scan_pos = length - pos
+                        break
+                    start = pos
+                    pos = end + 1
+                    scan = 0
+                    try:
+                        decoded = json.loads(bytes(view[start:end]))
+                    except ValueError as err:
+                        logger.error("Invalid JSON frame: %s", err)
+                        continue
                 self.frame_received(decoded)
-            else:
-                self._frame_buf += data
-                return
+        return pos
+
+    def _protocol_error(self, message):
+        logger.error("%s, closing connection", message)
+        self._frame_buf.clear()
+        self._scan_pos = 0
+        if self.transport:
+            self.transport.close()
 
     def frame_received(self, frame):
         logger.debug("Frame received: %r", frame)
@@ -49,7 +305,82 @@ class CommProtocol(asyncio.Protocol):
                 logger.debug("Unknown command received: %r", command)
 
     def send_frame(self, frame):
-        logger.debug("Sending frame: %r", frame)
-        encoded = json.dumps(frame).encode("utf-8")
-        self.transport.write(encoded + b'\x00')
+        """Queue commands of `frame` to be sent.
+
+        All commands queued within one loop iteration go in one frame."""
+        logger.debug("Queueing frame: %r", frame)
+        if self.transport and self.transport.is_closing():
+            return
+        self._out_queue += frame
+        if self._paused:
+            self._check_queue()
+        elif not self._flush_handle:
+            if self.loop and self.loop.is_running():
+                self._flush_handle = self.loop.call_soon(self.flush)
+            else:
+                self.flush()
+
+    def send_latest(self, key, command):
+        """Queue a value update, replacing a queued update of the same
+        `key` while the peer does not keep up."""
+        if not self._paused:
+            self.send_frame([command])
+            return
+        logger.debug("Queueing update %r: %r", key, command)
+        if self._latest.pop(key, None) is not None:
+            self.dropped_count += 1
+        self._latest[key] = command
 
+    def _check_queue(self):
+        """Disconnect a peer not reading what cannot be dropped."""
+        queued = len(self._out_queue)
+        if queued >= MAX_QUEUED_COMMANDS_HARD:
+            self._disconnect_slow_peer("{} commands queued".format(queued))
+        elif queued > MAX_QUEUED_COMMANDS and not self._overflow_handle:
+            logger.warning("Peer not reading, %i commands queued", queued)
+            self._overflow_handle = self.loop.call_later(
+                    QUEUE_OVERFLOW_TIMEOUT, self._queue_overflow)
+
+    def _queue_overflow(self):
+        self._overflow_handle = None
+        if self._paused and len(self._out_queue) > MAX_QUEUED_COMMANDS:
+            self._disconnect_slow_peer("Peer not reading for {} s"
+                                       .format(QUEUE_OVERFLOW_TIMEOUT))
+
+    def _disconnect_slow_peer(self, message):
+        self.dropped_count += len(self._out_queue) + len(self._latest)
+        self._out_queue = []
+        self._latest = {}
+        self._protocol_error(message)
+
+    def _cancel_overflow(self):
+        if self._overflow_handle:
+            self._overflow_handle.cancel()
+            self._overflow_handle = None
+
+    def flush(self):
+        """Send the queued commands now."""
+        if self._flush_handle:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if self._paused:
+            return
+        if self._latest:
+            self._out_queue += self._latest.values()
+            self._latest = {}
+        if not self._out_queue:
+            return
+        if not self.transport or self.transport.is_closing():
+            self._out_queue = []
+            return
+        frame = self._out_queue
+        self._out_queue = []
+        logger.debug("Sending frame: %r", frame)
+        if self.encoding == "local":
+            self.transport.write_frame(frame)
+            return
+        if self.encoding == "binary":
+            encoded = encode_binary(frame)
+        else:
+            encoded = encode_json(frame)
+        self.transport.write(encoded)
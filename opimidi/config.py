@@ -4,12 +4,52 @@ from collections import OrderedDict
 import logging
 import os
 
+from .ops import parse_ops
+
 logger = logging.getLogger("config")
 
+# settings holding op expressions
+BANK_OP_KEYS = ["enter", "leave"]
+PROGRAM_OP_KEYS = ["enter", "leave", "button_A", "button_B",
+                   "pedal_1", "pedal_2"]
+
+def _compile_ops(section, keys, errors, previous=None):
+    """Parse op expressions of a bank or a program.
+
+    Ops of the `previous` version of the section are reused for
+    unchanged expressions. Return True if anything had to be parsed."""
+    ops = {}
+    sources = {}
+    parsed = False
+    for key in keys:
+        try:
+            if key not in section:
+                continue
+            source = section.settings[key]
+            if previous is not None and previous.sources.get(key) == source:
+                ops[key] = previous.ops[key]
+            else:
+                ops[key] = tuple(parse_ops(source))
+                parsed = True
+            sources[key] = source
+        except (ValueError, configparser.Error) as err:
+            if isinstance(section, ConfigProgram):
+                location = "{}:{}".format(section.bank.name, section.name)
+            else:
+                location = "{}:".format(section.name)
+            logger.error("Config error: [%s] %r: %s", location, key, err)
+            errors.append((location, key, str(err)))
+    section.ops = ops
+    section.sources = sources
+    return parsed
+
 class ConfigBank:
     def __init__(self, name, settings=None):
         self.name = name
         self.programs = OrderedDict()
+        self.ops = {}
+        # op expressions the ops were compiled from
+        self.sources = {}
         if settings:
             self.settings = settings
         else:
@@ -20,14 +60,20 @@ class ConfigBank:
         try:
             return self.settings[key]
         except configparser.Error as err:
-            logger.error("Config error: [%s:%s] %r: %s",
-                         self.bank.name, self.name, key, err)
+            logger.error("Config error: [%s:] %r: %s",
+                         self.name, key, err)
             raise KeyError(key)
+    def get_ops(self, key):
+        """Compiled ops of a setting, empty tuple if not set."""
+        return self.ops.get(key, ())
 
 class ConfigProgram:
     def __init__(self, bank, name, settings=None):
         self.bank = bank
         self.name = name
+        self.ops = {}
+        # op expressions the ops were compiled from
+        self.sources = {}
         if settings:
             self.settings = settings
         else:
@@ -41,15 +87,25 @@ class ConfigProgram:
             logger.error("Config error: [%s:%s] %r: %s",
                          self.bank.name, self.name, key, err)
             raise KeyError(key)
+    def get_ops(self, key):
+        """Compiled ops of a setting, empty tuple if not set."""
+        return self.ops.get(key, ())
 
 class Config:
-    def __init__(self):
+    def __init__(self, path=None, previous=None):
+        """Load config from `path` or the default location.
+
+        Ops of the `previous` config (when reloading) are reused where
+        their expressions have not changed."""
         self.config = configparser.ConfigParser(
                 interpolation=configparser.ExtendedInterpolation())
-        if os.path.exists("opimidi.config"):
-            self.config.read("opimidi.config")
+        if path:
+            self.path = path
+        elif os.path.exists("opimidi.config"):
+            self.path = "opimidi.config"
         else:
-            self.config.read("/etc/opimidi.config")
+            self.path = "/etc/opimidi.config"
+        self.config.read(self.path)
         self.banks = OrderedDict()
         for section in self.config:
             if ":" in section:
@@ -65,9 +121,47 @@ class Config:
                     bank.programs[program_n] = program
                 else:
                     bank.settings = self.config[section]
+        self.errors = []
+        self.compile(previous)
+    def compile(self, previous=None):
+        """Parse all op expressions, so program switches need no parsing.
+
+        Errors are logged and collected in `self.errors`."""
+        errors = []
+        compiled = 0
+        for bank in self.banks.values():
+            old_bank = previous.banks.get(bank.name) if previous else None
+            _compile_ops(bank, BANK_OP_KEYS, errors, old_bank)
+            for program in bank.programs.values():
+                if old_bank:
+                    old_program = old_bank.programs.get(program.name)
+                else:
+                    old_program = None
+                if _compile_ops(program, PROGRAM_OP_KEYS, errors, old_program):
+                    compiled += 1
+        logger.debug("Compiled ops of %i programs", compiled)
+        self.errors = errors
+        return errors
+    def has_programs(self):
+        return any(bank.programs for bank in self.banks.values())
     def get_banks(self):
         return list(self.banks.values())
     def get_program(self, bank_name, program_name):
         bank = self.banks[bank_name]
         return bank.programs[program_name]
+    def get_settings(self, name):
+        """Settings of a non-program section (e.g. [midi])."""
+        if self.config.has_section(name):
+            return self.config[name]
+        return {}
+    def get_input_settings(self, name):
+        """Settings of a physical input (e.g. [pedal_1] section)."""
+        return self.get_settings(name)
+
 
+if __name__ == "__main__":
+    # validate a config file: python3 -m opimidi.config [path]
+    import sys
+    logging.basicConfig(level=logging.INFO)
+    config = Config(sys.argv[1] if len(sys.argv) > 1 else None)
+    sys.exit(1 if config.errors else 0)
@@ -0,0 +1,146 @@
+"""Config file change detection.
+
+The directory of the config file is watched with inotify, so changes
+are noticed whether the file is rewritten in place or replaced (as
+most editors do). The new config is parsed in a worker thread and only
+used when it has no errors.
+"""
+
+import asyncio
+import ctypes
+import ctypes.util
+import logging
+import os
+import struct
+
+from .config import Config
+
+logger = logging.getLogger("config_watcher")
+
+# from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+
+# wd, mask, cookie, name length
+INOTIFY_EVENT = struct.Struct("iIII")
+
+# wait for the writes to settle before reloading
+RELOAD_DELAY = 0.5
+
+_libc = None
+
+def _inotify_call(name, *args):
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6",
+                            use_errno=True)
+    result = getattr(_libc, name)(*args)
+    if result < 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
+    return result
+
+def _event_names(data):
+    """Names of the files from a buffer of inotify events."""
+    offset = 0
+    while offset + INOTIFY_EVENT.size <= len(data):
+        _, mask, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+        offset += INOTIFY_EVENT.size
+        if mask & IN_Q_OVERFLOW:
+            # lost events, could be ours
+            yield None
+        else:
+            yield data[offset:offset + length].rstrip(b"\x00")
+        offset += length
+
+class ConfigWatcher:
+    """Reload the config when the file changes.
+
+    `callback` is called with the new Config."""
+    def __init__(self, loop, config, callback):
+        self.loop = loop
+        self.config = config
+        self.callback = callback
+        directory, name = os.path.split(os.path.abspath(config.path))
+        self.directory = directory
+        self.name = os.fsencode(name)
+        self._fd = None
+        self._reload_handle = None
+        self._future = None
+        self._reload_again = False
+
+    def start(self):
+        """Start watching, return False if not possible."""
+        try:
+            self._fd = _inotify_call("inotify_init1",
+                                     os.O_NONBLOCK | os.O_CLOEXEC)
+            _inotify_call("inotify_add_watch", self._fd,
+                          os.fsencode(self.directory),
+                          IN_CLOSE_WRITE | IN_MOVED_TO)
+        except (OSError, AttributeError) as err:
+            logger.warning("Cannot watch %r for changes: %s",
+                           self.config.path, err)
+            self.close()
+            return False
+        self.loop.add_reader(self._fd, self._read_events)
+        logger.debug("Watching %r for changes", self.config.path)
+        return True
+
+    def close(self):
+        if self._reload_handle:
+            self._reload_handle.cancel()
+            self._reload_handle = None
+        if self._fd is not None:
+            self.loop.remove_reader(self._fd)
+            os.close(self._fd)
+            self._fd = None
+
+    def _read_events(self):
+        try:
+            data = os.read(self._fd, 4096)
+        except BlockingIOError:
+            return
+        for name in _event_names(data):
+            if name is None or name == self.name:
+                self._schedule_reload()
+                break
+
+    def _schedule_reload(self):
+        if self._reload_handle:
+            self._reload_handle.cancel()
+        self._reload_handle = self.loop.call_later(RELOAD_DELAY, self.reload)
+
+    def reload(self):
+        """Load the config again, in the background."""
+        self._reload_handle = None
+        if self._future:
+            self._reload_again = True
+            return
+        logger.info("Reloading %r", self.config.path)
+        self._future = self.loop.run_in_executor(None, Config,
+                                                 self.config.path, self.config)
+        self._future.add_done_callback(self._reloaded)
+
+    def _reloaded(self, future):
+        self._future = None
+        try:
+            config = future.result()
+        except asyncio.CancelledError:
+            return
+        except Exception:
+            logger.exception("Could not reload the config")
+            config = None
+        if config is None:
+            pass
+        elif config.errors:
+            logger.error("%i errors in the new config, keeping the old one",
+                         len(config.errors))
+        elif not config.has_programs():
+            logger.error("No programs in the new config, keeping the old one")
+        else:
+            self.config = config
+            self.callback(config)
+        if self._reload_again:
+            self._reload_again = False
+            self.reload()
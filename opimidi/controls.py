@@ -0,0 +1,140 @@
+"""MIDI controller state.
+
+ControllerState keeps the last known value of every controller and the
+current program of each of the 16 MIDI channels of one port, in flat
+arrays, so updating it on every pedal event allocates nothing.
+"""
+
+from array import array
+import logging
+
+from .alsa import seq
+
+logger = logging.getLogger("controls")
+
+CHANNELS = 16
+CONTROLLERS = 128
+
+# unknown value marker
+UNKNOWN = -1
+
+# (N)RPN parameter number controllers
+CC_NRPN_MSB = 99
+CC_NRPN_LSB = 98
+CC_RPN_MSB = 101
+CC_RPN_LSB = 100
+
+RPN_FLAG = 0x4000
+
+_PARAM_SELECT = {
+        CC_NRPN_MSB: (CC_NRPN_MSB, CC_NRPN_LSB, 0),
+        CC_NRPN_LSB: (CC_NRPN_MSB, CC_NRPN_LSB, 0),
+        CC_RPN_MSB: (CC_RPN_MSB, CC_RPN_LSB, RPN_FLAG),
+        CC_RPN_LSB: (CC_RPN_MSB, CC_RPN_LSB, RPN_FLAG),
+        }
+
+class ControllerState:
+    def __init__(self):
+        # 7-bit controller values, [channel * CONTROLLERS + param]
+        self.cc = array("h", [UNKNOWN]) * (CHANNELS * CONTROLLERS)
+        # current program of each channel
+        self.program = array("h", [UNKNOWN]) * CHANNELS
+        # (N)RPN parameter selected by the last of the parameter number
+        # controllers received, with RPN_FLAG set for RPNs
+        self.selected = array("l", [UNKNOWN]) * CHANNELS
+
+    def clear(self):
+        self.cc[:] = array("h", [UNKNOWN]) * len(self.cc)
+        self.program[:] = array("h", [UNKNOWN]) * len(self.program)
+        self.selected[:] = array("l", [UNKNOWN]) * len(self.selected)
+
+    def get_cc(self, channel, param):
+        """7-bit controller value, None if not known."""
+        value = self.cc[channel * CONTROLLERS + param]
+        return None if value == UNKNOWN else value
+
+    def set_cc(self, channel, param, value):
+        self.cc[channel * CONTROLLERS + param] = value
+        if param in _PARAM_SELECT:
+            msb_param, lsb_param, flag = _PARAM_SELECT[param]
+            number = self.get_cc14(channel, msb_param, lsb_param)
+            if number is None:
+                self.selected[channel] = UNKNOWN
+            else:
+                self.selected[channel] = flag | number
+
+    def get_cc14(self, channel, param, lsb_param=None):
+        """14-bit value of controller pair `param` (0-31) and `param + 32`
+        (or `lsb_param`).
+
+        None if the MSB is not known, a missing LSB counts as 0."""
+        base = channel * CONTROLLERS
+        if lsb_param is None:
+            lsb_param = param + 32
+        msb = self.cc[base + param]
+        if msb == UNKNOWN:
+            return None
+        lsb = self.cc[base + lsb_param]
+        if lsb == UNKNOWN:
+            lsb = 0
+        return (msb << 7) | lsb
+
+    def set_cc14(self, channel, param, value):
+        base = channel * CONTROLLERS + param
+        self.cc[base] = (value >> 7) & 0x7f
+        self.cc[base + 32] = value & 0x7f
+
+    def get_selected_parameter(self, channel):
+        """(registered, number) of the selected (N)RPN, None if unknown."""
+        value = self.selected[channel]
+        if value == UNKNOWN:
+            return None
+        return (bool(value & RPN_FLAG), value & 0x3fff)
+
+    def get_program(self, channel):
+        value = self.program[channel]
+        return None if value == UNKNOWN else value
+
+    def set_program(self, channel, value):
+        self.program[channel] = value
+
+    def known_cc(self):
+        """Iterate over (channel, param, value) of the known controllers."""
+        for index, value in enumerate(self.cc):
+            if value != UNKNOWN:
+                yield index // CONTROLLERS, index % CONTROLLERS, value
+
+    def update(self, event):
+        """Update the state with a sent or received event."""
+        ev_type = event.type
+        if ev_type == seq.EVENT_CONTROLLER:
+            self.set_cc(event.channel & 0x0f, event.param & 0x7f, event.value)
+        elif ev_type == seq.EVENT_CONTROL14:
+            if event.param < 32:
+                self.set_cc14(event.channel & 0x0f, event.param, event.value)
+            else:
+                self.set_cc(event.channel & 0x0f, event.param & 0x7f,
+                            event.value & 0x7f)
+        elif ev_type == seq.EVENT_PGMCHANGE:
+            self.program[event.channel & 0x0f] = event.value
+
+    def update_many(self, events):
+        for event in events:
+            self.update(event)
+
+    def snapshot(self):
+        """Copy of the state, as bytes."""
+        return (self.cc.tobytes() + self.program.tobytes()
+                + self.selected.tobytes())
+
+    def restore(self, snapshot):
+        """Restore state saved by `snapshot()`."""
+        cc_size = (len(self.cc) + len(self.program)) * self.cc.itemsize
+        if len(snapshot) != cc_size + len(self.selected) * self.selected.itemsize:
+            raise ValueError("Invalid controller state snapshot")
+        cc = array("h")
+        cc.frombytes(snapshot[:cc_size])
+        self.cc[:] = cc[:len(self.cc)]
+        self.program[:] = cc[len(self.cc):]
+        self.selected[:] = array("l")
+        self.selected.frombytes(snapshot[cc_size:])
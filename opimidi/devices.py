@@ -0,0 +1,82 @@
+"""Cache of the hardware device locations.
+
+Finding a device means scanning sysfs or opening every input device to
+check its name. The paths found are remembered in a small JSON file
+under /run/opimidi (first written at boot by opimidi_set_permissions),
+with the inode number and modification time of each path, so entries of
+devices gone or re-created since are not used.
+"""
+
+import json
+import logging
+import os
+import threading
+
+logger = logging.getLogger("devices")
+
+CACHE_DIR = os.environ.get("XDG_RUNTIME_DIR", "/run/opimidi")
+CACHE_PATH = os.path.join(CACHE_DIR, "devices.json")
+
+# devices may be looked up from the LCD thread too
+_lock = threading.Lock()
+# kind -> name -> [path, [inode, mtime]]
+_cache = None
+
+def _stat_key(path):
+    stat = os.stat(path)
+    return [stat.st_ino, stat.st_mtime_ns]
+
+def _load():
+    global _cache
+    if _cache is None:
+        try:
+            with open(CACHE_PATH, "rt") as cache_f:
+                _cache = json.load(cache_f)
+        except (OSError, ValueError) as err:
+            logger.debug("No usable device cache: %s", err)
+            _cache = {}
+    return _cache
+
+def _save(cache):
+    tmp_path = "{}.{}".format(CACHE_PATH, os.getpid())
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with open(tmp_path, "wt") as cache_f:
+            json.dump(cache, cache_f)
+        os.rename(tmp_path, CACHE_PATH)
+    except OSError as err:
+        logger.debug("Could not write the device cache: %s", err)
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+
+def lookup(kind, name):
+    """Cached path of the `kind` device `name`, None if unknown or stale."""
+    with _lock:
+        entry = _load().get(kind, {}).get(name)
+    if not entry:
+        return None
+    path, key = entry
+    try:
+        if _stat_key(path) == key:
+            logger.debug("%s device %r is %r (cached)", kind, name, path)
+            return path
+    except OSError:
+        pass
+    logger.debug("Stale cache entry for %s device %r", kind, name)
+    return None
+
+def remember(kind, name, path):
+    """Store the path of a device found."""
+    try:
+        entry = [path, _stat_key(path)]
+    except OSError as err:
+        logger.debug("Cannot cache %s device %r: %s", kind, name, err)
+        return
+    with _lock:
+        cache = _load()
+        devices = cache.setdefault(kind, {})
+        if devices.get(name) != entry:
+            devices[name] = entry
+            _save(cache)
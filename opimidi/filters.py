@@ -0,0 +1,254 @@
+"""Pedal signal processing.
+
+Filters work on the relative input value (0.0 - 1.0) and are configured
+per input in the config file, e.g.:
+
+    [pedal_1]
+    smoothing = ema 0.3
+    hysteresis = 0.01
+    dead_zone = 0.03 0.02
+    curve = log
+    max_rate = 50
+"""
+
+import logging
+import math
+
+logger = logging.getLogger("filters")
+
+# output resolution, fine enough for 14-bit controllers
+RESOLUTION = 16384
+
+class Filter:
+    def process(self, value, timestamp):
+        """Return filtered value or None to suppress it (for now)."""
+        raise NotImplementedError
+
+class EMAFilter(Filter):
+    """Exponential moving average."""
+    def __init__(self, alpha=0.5):
+        if not 0.0 < alpha <= 1.0:
+            raise ValueError("EMA alpha must be in (0, 1]")
+        self.alpha = alpha
+        self.value = None
+
+    def process(self, value, timestamp):
+        if self.value is None:
+            self.value = value
+        else:
+            self.value += self.alpha * (value - self.value)
+        return self.value
+
+    def __repr__(self):
+        return "EMAFilter({!r})".format(self.alpha)
+
+class OneEuroFilter(Filter):
+    """The 1€ filter: smoothing adapting to the speed of change.
+
+    See: http://cristal.univ-lille.fr/~casiez/1euro/"""
+    def __init__(self, min_cutoff=1.0, beta=0.0, d_cutoff=1.0):
+        if min_cutoff <= 0 or d_cutoff <= 0:
+            raise ValueError("1€ filter cutoff frequencies must be positive")
+        self.min_cutoff = min_cutoff
+        self.beta = beta
+        self.d_cutoff = d_cutoff
+        self.value = None
+        self.d_value = 0.0
+        self.timestamp = None
+
+    @staticmethod
+    def _alpha(cutoff, dt):
+        tau = 1.0 / (2 * math.pi * cutoff)
+        return 1.0 / (1.0 + tau / dt)
+
+    def process(self, value, timestamp):
+        if self.value is None:
+            self.value = value
+            self.timestamp = timestamp
+            return value
+        dt = timestamp - self.timestamp
+        if dt <= 0:
+            return self.value
+        self.timestamp = timestamp
+        d_value = (value - self.value) / dt
+        alpha_d = self._alpha(self.d_cutoff, dt)
+        self.d_value += alpha_d * (d_value - self.d_value)
+        cutoff = self.min_cutoff + self.beta * abs(self.d_value)
+        self.value += self._alpha(cutoff, dt) * (value - self.value)
+        return self.value
+
+    def __repr__(self):
+        return "OneEuroFilter({!r}, {!r}, {!r})".format(
+                self.min_cutoff, self.beta, self.d_cutoff)
+
+class Hysteresis(Filter):
+    """Ignore changes smaller than `threshold`."""
+    def __init__(self, threshold):
+        self.threshold = threshold
+        self.value = None
+
+    def process(self, value, timestamp):
+        if self.value is None or abs(value - self.value) >= self.threshold:
+            self.value = value
+        return self.value
+
+    def __repr__(self):
+        return "Hysteresis({!r})".format(self.threshold)
+
+class DeadZone(Filter):
+    """Snap to the ends when near them, stretching the rest."""
+    def __init__(self, low, high=None):
+        if high is None:
+            high = low
+        if low < 0 or high < 0 or low + high >= 1.0:
+            raise ValueError("Invalid dead zones")
+        self.low = low
+        self.high = high
+
+    def process(self, value, timestamp):
+        if value <= self.low:
+            return 0.0
+        elif value >= 1.0 - self.high:
+            return 1.0
+        return (value - self.low) / (1.0 - self.low - self.high)
+
+    def __repr__(self):
+        return "DeadZone({!r}, {!r})".format(self.low, self.high)
+
+class Curve(Filter):
+    """Response curve: 'log', 'exp' or a lookup table.
+
+    The table values are evenly spread over the input range and linearly
+    interpolated."""
+    def __init__(self, kind, steepness=9.0):
+        if kind == "log":
+            self.table = None
+            self.func = lambda x: math.log1p(steepness * x) / math.log1p(steepness)
+        elif kind == "exp":
+            self.table = None
+            self.func = lambda x: math.expm1(steepness * x / 4) / math.expm1(steepness / 4)
+        elif kind == "linear":
+            self.table = None
+            self.func = lambda x: x
+        else:
+            self.table = [float(v) for v in kind]
+            if len(self.table) < 2:
+                raise ValueError("Lookup table needs at least two values")
+            self.func = self._lookup
+        self.kind = kind
+
+    def _lookup(self, value):
+        table = self.table
+        pos = value * (len(table) - 1)
+        i = min(int(pos), len(table) - 2)
+        return table[i] + (table[i + 1] - table[i]) * (pos - i)
+
+    def process(self, value, timestamp):
+        return min(max(self.func(value), 0.0), 1.0)
+
+    def __repr__(self):
+        return "Curve({!r})".format(self.kind)
+
+class RateLimit(Filter):
+    """Pass at most `max_rate` values per second.
+
+    Values suppressed are not lost: as the input is processed on every
+    sample, the latest one passes when the time window is over.
+
+    Applied by FilterChain after the other filters and the change check,
+    so only values actually emitted start a new window."""
+    def __init__(self, max_rate):
+        if max_rate <= 0:
+            raise ValueError("max_rate must be positive")
+        self.max_rate = max_rate
+        self.min_interval = 1.0 / max_rate
+        self.last_ts = None
+
+    def process(self, value, timestamp):
+        if self.last_ts is not None and timestamp - self.last_ts < self.min_interval:
+            return None
+        self.last_ts = timestamp
+        return value
+
+    def __repr__(self):
+        return "RateLimit({!r})".format(self.max_rate)
+
+class FilterChain:
+    def __init__(self, filters, rate_limit=None):
+        self.filters = filters
+        self.rate_limit = rate_limit
+        self.last_value = None
+
+    def process(self, value, timestamp):
+        """Return new output value or None when there is no change."""
+        for flt in self.filters:
+            value = flt.process(value, timestamp)
+            if value is None:
+                return None
+        value = round(value * RESOLUTION) / RESOLUTION
+        if value == self.last_value:
+            return None
+        if (self.rate_limit is not None
+                and self.rate_limit.process(value, timestamp) is None):
+            return None
+        self.last_value = value
+        return value
+
+    def __repr__(self):
+        if self.rate_limit is not None:
+            return "FilterChain({!r}, {!r})".format(self.filters,
+                                                    self.rate_limit)
+        return "FilterChain({!r})".format(self.filters)
+
+def _floats(string):
+    return [float(v) for v in string.split()]
+
+def _check_count(name, args, min_count, max_count):
+    if not min_count <= len(args) <= max_count:
+        if min_count == max_count:
+            expected = str(min_count)
+        else:
+            expected = "{}-{}".format(min_count, max_count)
+        raise ValueError("{} takes {} values, got {}"
+                         .format(name, expected, len(args)))
+    return args
+
+def make_filter_chain(settings):
+    """Build FilterChain from input settings, None if no filters configured.
+
+    Raises ValueError on invalid settings."""
+    filters = []
+    smoothing = settings.get("smoothing", "").split()
+    if smoothing:
+        kind, args = smoothing[0], [float(v) for v in smoothing[1:]]
+        if kind == "ema":
+            filters.append(EMAFilter(*_check_count("ema", args, 0, 1)))
+        elif kind in ("one_euro", "1euro"):
+            filters.append(OneEuroFilter(*_check_count("one_euro",
+                                                       args, 0, 3)))
+        elif kind != "none":
+            raise ValueError("Unknown smoothing: {!r}".format(kind))
+    if settings.get("hysteresis"):
+        threshold = float(settings["hysteresis"])
+        if threshold < 0:
+            raise ValueError("hysteresis must not be negative")
+        filters.append(Hysteresis(threshold))
+    if settings.get("dead_zone"):
+        args = _check_count("dead_zone", _floats(settings["dead_zone"]), 1, 2)
+        filters.append(DeadZone(*args))
+    curve = settings.get("curve", "").split()
+    if len(curve) == 1 and curve[0] in ("log", "exp", "linear"):
+        filters.append(Curve(curve[0]))
+    elif len(curve) == 2 and curve[0] in ("log", "exp"):
+        steepness = float(curve[1])
+        if steepness <= 0:
+            raise ValueError("curve steepness must be positive")
+        filters.append(Curve(curve[0], steepness))
+    elif curve:
+        filters.append(Curve([float(v) for v in curve]))
+    rate_limit = None
+    if settings.get("max_rate"):
+        rate_limit = RateLimit(float(settings["max_rate"]))
+    if not filters and rate_limit is None:
+        return None
+    return FilterChain(filters, rate_limit)
@@ -21,10 +21,22 @@ class FrontendProtocol(CommProtocol):
     def __init__(self, loop):
         CommProtocol.__init__(self, loop)
         self.ui = None
+    def connection_made(self, transport):
+        super().connection_made(transport)
+        self.negotiate_encoding()
     def cmd_input_event(self, timestamp, type, code, value, timedelta):
         event = InputEvent(timestamp, type, code, value, timedelta)
         if self.ui:
             self.ui.handle_event(event)
+    def cmd_midi_cc(self, channel, param, value):
+        if self.ui:
+            self.ui.midi_monitor.handle_midi_cc(channel, param, value)
+    def cmd_midi_program(self, channel, value):
+        if self.ui:
+            self.ui.midi_monitor.handle_midi_program(channel, value)
+    def cmd_config_reloaded(self):
+        if self.ui:
+            self.ui.reload_config()
 
 def main():
     parser = argparse.ArgumentParser(description="OPiMIDI")
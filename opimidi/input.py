@@ -4,11 +4,14 @@ import evdev
 import glob
 import logging
 import os
+import threading
 import time
 
 from collections import namedtuple
 
+from . import devices
 from .exceptions import HardwareInitError
+from .filters import make_filter_chain
 from .util import run_async_jobs
 
 logger = logging.getLogger("input")
@@ -21,11 +24,27 @@ HWMON_DEVICES = {
         "pcf8591": ["in0", "in1"],
         }
 
+# same inputs via the IIO buffered interface, used when available
+IIO_DEVICES = {
+        "pcf8591": ["in0", "in1"],
+        }
+# trigger to assign to the IIO device, None to keep the current one
+IIO_TRIGGER = None
+IIO_BUFFER_LENGTH = 16
+
 PEDALS_DEVICE_NAME = "pcf8591"
 PEDALS_INPUTS = ["in0", "in1"]
+# poll interval while the pedals move
 PEDALS_POLL_INTERVAL = 0.01
+# poll interval the idle pedals back off to (the worst-case latency)
+PEDALS_MAX_POLL_INTERVAL = 0.08
+# number of polls without change before backing off
+PEDALS_IDLE_POLLS = 50
 PEDALS_SENSITIVITY = 4
 
+# config sections with settings of the analog inputs, by event code
+PEDAL_NAMES = ["pedal_1", "pedal_2"]
+
 InputEvent = namedtuple("InputEvent", "timestamp type code value timedelta")
 
 class EventHandler:
@@ -43,12 +62,25 @@ class EvdevInput:
         self._find_device(device_name)
 
     def _find_device(self, device_name):
+        dev_fn = devices.lookup("evdev", device_name)
+        if dev_fn:
+            try:
+                dev = evdev.InputDevice(dev_fn)
+            except OSError as err:
+                logger.debug("%s: %s", dev_fn, err)
+            else:
+                if dev.name == device_name:
+                    self.dev = dev
+                    return
+                dev.close()
         for dev_fn in evdev.list_devices():
             dev = evdev.InputDevice(dev_fn)
             logger.debug("%s: %r", dev_fn, dev.name)
             if dev.name == device_name:
                 self.dev = dev
+                devices.remember("evdev", device_name, dev_fn)
                 break
+            dev.close()
         else:
             raise HardwareInitError("Could not find '{}' event device"
                                     .format(device_name))
@@ -86,83 +118,416 @@ class EvdevInput:
                              evdev.util.categorize(event))
 
 class HwmonInput:
-    def __init__(self, device_name, input_names):
+    # default raw value units per value unit
+    value_divider = 10
+
+    def __init__(self, device_name, input_names,
+                 poll_interval=PEDALS_POLL_INTERVAL,
+                 max_poll_interval=PEDALS_MAX_POLL_INTERVAL,
+                 settings=None):
+        """`settings` is a list of setting mappings, one per input."""
+        if not settings:
+            settings = [{}] * len(input_names)
+        self.dividers = []
+        self.sensitivities = []
+        self.filters = []
+        for input_settings in settings:
+            index = len(self.filters)
+            try:
+                divider = int(input_settings.get("divider",
+                                                 self.value_divider))
+                if divider <= 0:
+                    raise ValueError("divider must be positive")
+            except ValueError as err:
+                logger.warning("Invalid divider for %r input #%i,"
+                               " using %i: %s", device_name, index,
+                               self.value_divider, err)
+                divider = self.value_divider
+            try:
+                sensitivity = int(input_settings.get("sensitivity",
+                                                     PEDALS_SENSITIVITY))
+                if sensitivity < 0:
+                    raise ValueError("sensitivity must not be negative")
+            except ValueError as err:
+                logger.warning("Invalid sensitivity for %r input #%i,"
+                               " using %i: %s", device_name, index,
+                               PEDALS_SENSITIVITY, err)
+                sensitivity = PEDALS_SENSITIVITY
+            self.dividers.append(divider)
+            self.sensitivities.append(sensitivity)
+            try:
+                self.filters.append(make_filter_chain(input_settings))
+            except ValueError as err:
+                logger.error("Invalid filter settings for %r input #%i,"
+                             " not filtering it: %s", device_name,
+                             index, err)
+                self.filters.append(None)
         self.inputs = []
+        self.input_fds = []
         self.values = []
         self.rel_values = []
         self.min = []
         self.max = []
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max(poll_interval, max_poll_interval)
+        # sampler thread -> loop handoff: latest (seq, timestamp, value)
+        # per input, written only by the thread
+        self._slots = []
+        self._delivered = []
+        self._delivery_pending = False
+        # sample age at delivery to the loop
+        self.sample_count = 0
+        self.sample_age_max = 0.0
+        self.sample_age_avg = 0.0
         self._find_device(device_name, input_names)
 
     def _find_device(self, device_name, input_names):
-        for path in glob.glob("/sys/class/hwmon/*"):
-            dev_path = os.path.join(path, "device")
-            name_path = os.path.join(dev_path, "name")
-            with open(name_path, "rt") as name_f:
-                name = name_f.read().strip()
-            if name == device_name:
-                break
-        else:
-            raise HardwareInitError("Could not find '{}' hwmon device"
-                                    .format(device_name))
-        self.inputs = []
-        self.values = []
-        for input_name in PEDALS_INPUTS:
+        dev_path = devices.lookup("hwmon", device_name)
+        if not dev_path:
+            for path in glob.glob("/sys/class/hwmon/*"):
+                dev_path = os.path.join(path, "device")
+                name_path = os.path.join(dev_path, "name")
+                with open(name_path, "rt") as name_f:
+                    name = name_f.read().strip()
+                if name == device_name:
+                    devices.remember("hwmon", device_name, dev_path)
+                    break
+            else:
+                raise HardwareInitError("Could not find '{}' hwmon device"
+                                        .format(device_name))
+        self.close()
+        for input_name in input_names:
             input_path = os.path.join(dev_path, input_name + "_input")
             try:
-                with open(input_path, "rt") as input_f:
-                    value = int(input_f.read().strip())
+                input_fd = os.open(input_path, os.O_RDONLY)
+            except OSError as err:
+                raise HardwareInitError("Cannot open input {!r} on device {!r}: {}"
+                        .format(input_name, device_name, err))
+            self.inputs.append(input_path)
+            self.input_fds.append(input_fd)
+            try:
+                value = self._read_raw(input_fd)
             except (IOError, ValueError) as err:
+                self.close()
                 raise HardwareInitError("Cannot read input {!r} on device {!r}: {}"
                         .format(input_name, device_name, err))
-            self.inputs.append(input_path)
-            self.values.append(value // 10)
+            self.values.append(value // self.dividers[len(self.values)])
             self.rel_values.append(0.5)
         self.min = list(self.values)
         self.max = list(self.values)
 
+    def close(self):
+        for input_fd in self.input_fds:
+            os.close(input_fd)
+        self.inputs = []
+        self.input_fds = []
+        self.values = []
+        self.rel_values = []
+
+    @staticmethod
+    def _read_raw(input_fd):
+        # sysfs attributes are regenerated on every read from offset 0
+        return int(os.pread(input_fd, 32, 0))
+
     def get_write_files(self):
         return []
 
     def read_inputs(self):
         changed = []
-        for i, path in enumerate(self.inputs):
-            with open(path, "rt") as input_f:
-                raw_value = int(input_f.read().strip())
-            last_value = self.values[i]
-            value = raw_value // 10
-            if value == last_value:
+        timestamp = time.time()
+        for i, input_fd in enumerate(self.input_fds):
+            if self._update_value(i, self._read_raw(input_fd), timestamp):
+                changed.append(i)
+        return changed
+
+    def _update_value(self, i, raw_value, timestamp):
+        """Apply new raw reading of input `i`, return True if changed."""
+        value = raw_value // self.dividers[i]
+        sensitivity = self.sensitivities[i]
+        chain = self.filters[i]
+        if value == self.values[i] and not chain:
+            return False
+        max_v = self.max[i]
+        min_v = self.min[i]
+        if value > max_v:
+            logger.debug("%r > %r, recalibrating", value, max_v)
+            max_v = value
+            self.max[i] = max_v
+        elif value < min_v:
+            logger.debug("%r < %r, recalibrating", value, min_v)
+            min_v = value
+            self.min[i] = min_v
+        elif abs(value - self.values[i]) < sensitivity:
+            # ignore small changes
+            value = self.values[i]
+        elif  value < min_v + sensitivity:
+            value = min_v
+        elif value > max_v - sensitivity:
+            value = max_v
+        self.values[i] = value
+        if max_v == min_v:
+            return False
+        rel_value = float(value - min_v) / (max_v - min_v)
+        if chain:
+            # stateful filters need every sample, even without change
+            rel_value = chain.process(rel_value, timestamp)
+            if rel_value is None:
+                return False
+        if rel_value == self.rel_values[i]:
+            return False
+        self.rel_values[i] = rel_value
+        return True
+
+    def _emit(self, handler, timestamp, changed):
+        for i in changed:
+            ievent = InputEvent(timestamp, evdev.ecodes.EV_ABS, i,
+                                self.rel_values[i], 0)
+            handler.handle_event(ievent)
+
+    def get_stats(self):
+        """Sample age statistics (in seconds)."""
+        return {
+                "samples": self.sample_count,
+                "age_max": self.sample_age_max,
+                "age_avg": self.sample_age_avg,
+                }
+
+    def _sample_loop(self, loop, stop, handler):
+        """Sampler thread: poll the inputs and hand changes to the loop."""
+        interval = self.poll_interval
+        idle_polls = 0
+        seq = 0
+        while not stop.wait(interval):
+            timestamp = time.time()
+            try:
+                changed = self.read_inputs()
+            except (OSError, ValueError) as err:
+                logger.error("Cannot read pedals: %s", err)
                 continue
-            max_v = self.max[i]
-            min_v = self.min[i]
-            if value > max_v:
-                logger.debug("%r > %r, recalibrating", value, max_v)
-                max_v = value
-                self.max[i] = max_v
-            elif value < min_v:
-                logger.debug("%r < %r, recalibrating", value, min_v)
-                min_v = value
-                self.min[i] = min_v
-            elif abs(value - self.values[i]) < PEDALS_SENSITIVITY:
-                # ignore small changes
+            if changed:
+                if interval != self.poll_interval:
+                    logger.debug("pedals moving, polling every %.3fs",
+                                 self.poll_interval)
+                interval = self.poll_interval
+                idle_polls = 0
+                seq += 1
+                for i in changed:
+                    # a single reference store, no lock needed
+                    self._slots[i] = (seq, timestamp, self.rel_values[i])
+                if not self._delivery_pending:
+                    self._delivery_pending = True
+                    try:
+                        loop.call_soon_threadsafe(self._deliver, handler)
+                    except RuntimeError:
+                        # loop closed
+                        return
+            elif interval < self.max_poll_interval:
+                idle_polls += 1
+                if idle_polls >= PEDALS_IDLE_POLLS:
+                    interval = min(interval * 2, self.max_poll_interval)
+                    idle_polls = 0
+                    logger.debug("pedals idle, polling every %.3fs", interval)
+
+    def _deliver(self, handler):
+        # clear first, so a sample stored from now on schedules a new call
+        self._delivery_pending = False
+        now = time.time()
+        for i, slot in enumerate(self._slots):
+            if slot is None or slot[0] == self._delivered[i]:
                 continue
-            elif  value < min_v + PEDALS_SENSITIVITY:
-                value = min_v
-            elif value > max_v - PEDALS_SENSITIVITY:
-                value = max_v
-            self.values[i] = value
-            self.rel_values[i] = float(value - min_v) / (max_v - min_v)
-            changed.append(i)
+            seq, timestamp, value = slot
+            self._delivered[i] = seq
+            age = now - timestamp
+            self.sample_count += 1
+            self.sample_age_avg += (age - self.sample_age_avg) * 0.01
+            if age > self.sample_age_max:
+                self.sample_age_max = age
+            ievent = InputEvent(timestamp, evdev.ecodes.EV_ABS, i, value, 0)
+            handler.handle_event(ievent)
+
+    async def collect_events(self, handler):
+        loop = asyncio.get_event_loop()
+        self._slots = [None] * len(self.values)
+        self._delivered = [0] * len(self.values)
+        stop = threading.Event()
+        thread = threading.Thread(target=self._sample_loop,
+                                  args=(loop, stop, handler),
+                                  name="pedals", daemon=True)
+        thread.start()
+        try:
+            # sampling happens in the thread until we are cancelled
+            await loop.create_future()
+        finally:
+            stop.set()
+            logger.debug("Pedal sample age: %r", self.get_stats())
+
+class IIOInput(HwmonInput):
+    """Analog inputs read through the IIO buffered interface.
+
+    Samples are pushed by the kernel at the rate of the device trigger,
+    so there is no polling at all and the reads never block – no sampler
+    thread is needed."""
+    value_divider = 1
+
+    def __init__(self, device_name, input_names, setup=True, **kwargs):
+        """`setup=False` only finds the device, leaving the buffer alone
+        (enough for `get_write_files`)."""
+        self.setup = setup
+        super().__init__(device_name, input_names, **kwargs)
+
+    def _find_device(self, device_name, input_names):
+        path = devices.lookup("iio", device_name)
+        if not path:
+            for path in glob.glob("/sys/bus/iio/devices/iio:device*"):
+                try:
+                    with open(os.path.join(path, "name"), "rt") as name_f:
+                        name = name_f.read().strip()
+                except OSError:
+                    continue
+                if name == device_name:
+                    devices.remember("iio", device_name, path)
+                    break
+            else:
+                raise HardwareInitError("Could not find '{}' IIO device"
+                                        .format(device_name))
+        self.dev_path = path
+        self.dev_fd = None
+        self.input_names = list(input_names)
+        if self.setup:
+            try:
+                self._setup_buffer(path, input_names)
+                self.dev_fd = os.open(os.path.join("/dev",
+                                                   os.path.basename(path)),
+                                      os.O_RDONLY | os.O_NONBLOCK)
+            except (OSError, ValueError) as err:
+                self._disable_buffer()
+                raise HardwareInitError("Cannot set up IIO buffer of {!r}: {}"
+                                        .format(device_name, err))
+        # first reading comes with the first scan
+        self.values = [0] * len(input_names)
+        self.rel_values = [0.5] * len(input_names)
+        self.min = [None] * len(input_names)
+        self.max = [None] * len(input_names)
+
+    @staticmethod
+    def _sysfs_write(path, value):
+        with open(path, "wt") as sysfs_f:
+            print(value, file=sysfs_f)
+
+    def _setup_buffer(self, path, input_names):
+        scan_path = os.path.join(path, "scan_elements")
+        self._sysfs_write(os.path.join(path, "buffer", "enable"), 0)
+        if IIO_TRIGGER:
+            self._sysfs_write(os.path.join(path, "trigger", "current_trigger"),
+                              IIO_TRIGGER)
+        channels = []
+        for input_name in input_names:
+            # hwmon 'inN' is IIO 'in_voltageN'
+            channel = "in_voltage" + input_name[2:]
+            self._sysfs_write(os.path.join(scan_path, channel + "_en"), 1)
+            with open(os.path.join(scan_path, channel + "_index")) as index_f:
+                index = int(index_f.read())
+            with open(os.path.join(scan_path, channel + "_type")) as type_f:
+                ch_type = type_f.read().strip()
+            channels.append((index, ch_type))
+        # scan layout: enabled channels in index order, each aligned to
+        # its storage size
+        layout = []
+        offset = 0
+        for index, ch_type in sorted(channels):
+            endian, rest = ch_type.split(":")
+            bits, shift = rest.split(">>")
+            sign_bits, storage_bits = bits.split("/")
+            signed = sign_bits[0] == "s"
+            real_bits = int(sign_bits[1:])
+            size = int(storage_bits) // 8
+            offset = (offset + size - 1) // size * size
+            layout.append((offset, size, endian == "be", signed,
+                           real_bits, int(shift)))
+            offset += size
+        max_size = max(entry[1] for entry in layout)
+        self.scan_size = (offset + max_size - 1) // max_size * max_size
+        order = [index for index, _ in sorted(channels)]
+        # layout in the order of input_names
+        self.layout = [layout[order.index(index)] for index, _ in channels]
+        self._sysfs_write(os.path.join(path, "buffer", "length"),
+                          IIO_BUFFER_LENGTH)
+        self._sysfs_write(os.path.join(path, "buffer", "enable"), 1)
+
+    def _parse_scan(self, scan):
+        result = []
+        for offset, size, big_endian, signed, real_bits, shift in self.layout:
+            value = int.from_bytes(scan[offset:offset + size],
+                                   "big" if big_endian else "little")
+            value = (value >> shift) & ((1 << real_bits) - 1)
+            if signed and value & (1 << (real_bits - 1)):
+                value -= 1 << real_bits
+            result.append(value)
+        return result
+
+    def _update_value(self, i, raw_value, timestamp):
+        if self.min[i] is None:
+            self.values[i] = raw_value // self.dividers[i]
+            self.min[i] = self.max[i] = self.values[i]
+            return False
+        return super()._update_value(i, raw_value, timestamp)
+
+    def read_inputs(self):
+        try:
+            data = os.read(self.dev_fd, self.scan_size * IIO_BUFFER_LENGTH)
+        except BlockingIOError:
+            return []
+        if len(data) < self.scan_size:
+            return []
+        # only the latest complete scan matters
+        end = len(data) // self.scan_size * self.scan_size
+        scan = data[end - self.scan_size:end]
+        changed = []
+        timestamp = time.time()
+        for i, raw_value in enumerate(self._parse_scan(scan)):
+            if self._update_value(i, raw_value, timestamp):
+                changed.append(i)
         return changed
 
+    def _disable_buffer(self):
+        try:
+            self._sysfs_write(os.path.join(self.dev_path,
+                                           "buffer", "enable"), 0)
+        except OSError as err:
+            logger.debug("Could not disable IIO buffer: %s", err)
+
+    def close(self):
+        if getattr(self, "dev_fd", None) is not None:
+            os.close(self.dev_fd)
+            self.dev_fd = None
+            self._disable_buffer()
+
+    def get_write_files(self):
+        """The device node and the sysfs attributes the buffer setup
+        writes."""
+        path = self.dev_path
+        result = [os.path.join("/dev", os.path.basename(path)),
+                  os.path.join(path, "buffer", "enable"),
+                  os.path.join(path, "buffer", "length")]
+        if IIO_TRIGGER:
+            result.append(os.path.join(path, "trigger", "current_trigger"))
+        for input_name in self.input_names:
+            result.append(os.path.join(path, "scan_elements",
+                                       "in_voltage" + input_name[2:] + "_en"))
+        return result
+
     async def collect_events(self, handler):
-        while True:
-            await asyncio.sleep(PEDALS_POLL_INTERVAL)
-            timestamp = time.time()
-            for i in self.read_inputs():
-                ievent = InputEvent(timestamp, evdev.ecodes.EV_ABS, i,
-                                    self.rel_values[i], 0)
-                handler.handle_event(ievent)
+        loop = asyncio.get_event_loop()
+        data_ready = asyncio.Event()
+        loop.add_reader(self.dev_fd, data_ready.set)
+        try:
+            while True:
+                await data_ready.wait()
+                data_ready.clear()
+                timestamp = time.time()
+                self._emit(handler, timestamp, self.read_inputs())
+        finally:
+            loop.remove_reader(self.dev_fd)
 
 class EventPrinter:
     def handle_event(self, event):
@@ -172,7 +537,14 @@ class EventPrinter:
                 .format(event.timestamp, event.type, event.code,
                         event.value, event.timedelta))
 
-def make_devices():
+def _pedal_settings(config, count):
+    if config is None:
+        return None
+    return [config.get_input_settings(name) for name in PEDAL_NAMES[:count]]
+
+def make_devices(config=None, setup=True):
+    """Input devices found, `setup=False` when only their files are
+    needed."""
     result = []
     for device_name in EVDEV_DEVICES:
         try:
@@ -182,8 +554,19 @@ def make_devices():
             continue
         result.append(evdev_input)
     for device_name, input_names in HWMON_DEVICES.items():
+        if device_name in IIO_DEVICES:
+            try:
+                iio_input = IIOInput(device_name, IIO_DEVICES[device_name],
+                        setup=setup,
+                        settings=_pedal_settings(config, len(input_names)))
+            except HardwareInitError as err:
+                logger.debug(err)
+            else:
+                result.append(iio_input)
+                continue
         try:
-            hwmon_input = HwmonInput(device_name, input_names)
+            hwmon_input = HwmonInput(device_name, input_names,
+                        settings=_pedal_settings(config, len(input_names)))
         except HardwareInitError as err:
             logger.error(err)
             continue
@@ -192,7 +575,7 @@ def make_devices():
 
 def get_write_files():
     result = []
-    for device in make_devices():
+    for device in make_devices(setup=False):
         result += device.get_write_files()
     return result
 
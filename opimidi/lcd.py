@@ -1,26 +1,14 @@
 
-import glob
 import logging
 import os
 import time
 
 from .lcd_chars import LCD_CHARS
+from .lcd_io import GPIO_LINES, open_lcd_io
 
 logger = logging.getLogger("lcd")
 
 BACKLIGHT_LED = "/sys/devices/platform/opimidi-lcd-leds/leds/backlight"
-GPIO_LABEL = "pcf8574"
-
-GPIO_LINES = {
-        "RS": 0,
-        "RW": 1,
-        "E": 2,
-        # BL (3) is handled by gpio-leds interface
-        "DB4": 4,
-        "DB5": 5,
-        "DB6": 6,
-        "DB7": 7,
-        }
 
 CLEAR_DISPLAY_CMD = 0x01
 
@@ -46,55 +34,35 @@ CGRAM_ADDR_MASK = 0x3f
 SET_DDRAM_ADDR_CMD = 0x80
 DDRAM_ADDR_MASK = 0x7f
 
+RS_BIT = 1 << GPIO_LINES["RS"]
+RW_BIT = 1 << GPIO_LINES["RW"]
+E_BIT = 1 << GPIO_LINES["E"]
+DATA_SHIFT = GPIO_LINES["DB4"]
+DATA_MASK = 0x0f << DATA_SHIFT
+
 class LCD:
-    def __init__(self):
-        self._gpio_v_files = {}
+    lines = 2
+    width = 16
+
+    def __init__(self, io=None, init=True):
+        """`init=False` skips the display initialization, for when only
+        the device files are needed."""
         self._increment = None
         self._shift = None
         self._backlight_v_fn = os.path.join(BACKLIGHT_LED, "brightness")
-        self._find_gpio()
-        self._init()
-        self.lines = 2
-        self.width = 16
-
-    def _find_gpio(self):
-        for gpiochip_path in glob.glob("/sys/class/gpio/gpiochip*"):
-            label_fn = os.path.join(gpiochip_path, "label")
-            with open(label_fn, "rt") as label_f:
-                label = label_f.readline().strip()
-                logger.debug("%r is %r", os.path.basename(gpiochip_path), label)
-                if label == GPIO_LABEL:
-                    break
-        else:
-            raise FileNotFoundError("Could not find GPIO chip {!r}".format(GPIO_LABEL))
-
-        base_fn = os.path.join(gpiochip_path, "base")
-        with open(base_fn, "rt") as base_f:
-            base = int(base_f.readline().strip())
-
-        for name, bit in GPIO_LINES.items():
-            gpio_num = base + bit
-            logger.debug("%s is GPIO#%i", name, gpio_num)
-            bit_path = "/sys/class/gpio/gpio{}".format(gpio_num)
-            if not os.path.isdir(bit_path):
-                logger.debug("Exporting GPIO#%i", gpio_num)
-                with open("/sys/class/gpio/export", "wt") as export_f:
-                    print(gpio_num, file=export_f)
-            direction_fn = os.path.join(bit_path, "direction")
-            # check if direction is already ok, as we may have no permission
-            # to write there
-            with open(direction_fn, "rt") as direction_f:
-                direction = direction_f.readline().strip()
-            if direction != "out":
-                logger.debug("Setting GPIO#%i direction to 'out'", gpio_num)
-                with open(direction_fn, "wt") as direction_f:
-                    print("out", file=direction_f)
-            self._gpio_v_files[name] = os.path.join(bit_path, "value")
+        if io is None:
+            io = open_lcd_io()
+        self._io = io
+        # current state of the PCF8574 lines
+        self._image = 0
+        # DDRAM address counter, None when unknown
+        self._addr = None
+        if init:
+            self._init()
 
     def _init(self):
-        self._set_bit("RW", 0)
-        self._set_bit("RS", 0)
-        self._set_bit("E", 0)
+        self._image = 0
+        self._io.write(self._image)
 
         # initialize 4-bit interface and function
         self._write_4bits(0x03)
@@ -107,69 +75,84 @@ class LCD:
         time.sleep(0.0002)
 
         self._write_cmd(FUNCTION_SET_CMD | FS_2LINES | FS_FONT5x10)
-        self._write_cmd(CLEAR_DISPLAY_CMD)
-
-    def _set_bit(self, name, value):
-        fd = os.open(self._gpio_v_files[name], os.O_WRONLY)
-        try:
-            if value:
-                os.write(fd, b"1")
-            else:
-                os.write(fd, b"0")
-        finally:
-            os.close(fd)
-
-    def _write_4bits(self, value):
-        self._set_bit("E", 0)
-        self._set_bit("RW", 0)
-        self._set_bit("DB4", value & 0x01)
-        value >>= 1
-        self._set_bit("DB5", value & 0x01)
-        value >>= 1
-        self._set_bit("DB6", value & 0x01)
-        value >>= 1
-        self._set_bit("DB7", value & 0x01)
-        self._set_bit("E", 1)
-        # lets hope i2c speed is not too fast
-        self._set_bit("E", 0)
+        self.clear()
+
+    def close(self):
+        self._io.close()
+
+    def _nibble_images(self, value, rs=False):
+        image = self._image & ~(RS_BIT | RW_BIT | E_BIT | DATA_MASK)
+        image |= (value & 0x0f) << DATA_SHIFT
+        if rs:
+            image |= RS_BIT
+        images = []
+        if (image ^ self._image) & (RS_BIT | RW_BIT):
+            # RS/RW must settle before E goes up
+            images.append(image)
+        # data only needs to be valid at the E falling edge
+        images.append(image | E_BIT)
+        images.append(image)
+        self._image = image
+        return images
+
+    def _byte_images(self, data, rs=False):
+        return (self._nibble_images((data >> 4) & 0x0f, rs)
+                + self._nibble_images(data & 0x0f, rs))
+
+    def _write_4bits(self, value, rs=False):
+        self._io.write_many(self._nibble_images(value, rs))
+
+    def _write_8bits(self, data, rs=False):
+        if self._io.self_paced:
+            self._io.write_many(self._byte_images(data, rs))
+            return
+        self._write_4bits((data >> 4) & 0x0f, rs)
+        time.sleep(0.00005)
+        self._write_4bits(data & 0x0f, rs)
+        time.sleep(0.00005)
 
     def _write_cmd(self, cmd):
         logger.debug("    CMD:  0x%02x", cmd)
-        self._write_4bits((cmd >> 4) & 0x0f)
-        time.sleep(0.00005)
-        self._write_4bits(cmd & 0x0f)
-        time.sleep(0.00005)
+        self._write_8bits(cmd)
 
     def _write_byte(self, data):
         logger.debug("    data: 0x%02x", data)
-        self._set_bit("RS", 1)
-        self._write_4bits((data >> 4) & 0x0f)
-        time.sleep(0.00005)
-        self._write_4bits(data & 0x0f)
-        self._set_bit("RS", 0)
-        time.sleep(0.00005)
+        self._write_8bits(data, True)
 
     def define_user_chars(self):
         for i, ch_bytes in enumerate(LCD_CHARS):
             self.set_cgram_addr(i << 3)
-            for byte in ch_bytes:
-                self._write_byte(byte)
+            self.write_bytes(bytes(ch_bytes))
 
     def get_write_files(self):
-        return list(self._gpio_v_files.values()) + [self._backlight_v_fn]
+        return self._io.get_write_files() + [self._backlight_v_fn]
 
     def write_bytes(self, string):
         if not isinstance(string, bytes):
             string = string.encode("raw_unicode_escape", "replace")
-        for byte in string:
-            self._write_byte(byte)
+        if self._io.self_paced:
+            # whole string in a single burst
+            logger.debug("    data: %r", string)
+            images = []
+            for byte in string:
+                images += self._byte_images(byte, True)
+            self._io.write_many(images)
+        else:
+            for byte in string:
+                self._write_byte(byte)
+        if self._addr is not None:
+            self._addr += len(string)
 
     def set_backlight(self, on=True):
+        if self._io.set_backlight(on):
+            return
         with open(self._backlight_v_fn, "wt") as backlight_v_f:
             print(255 if on else 0, file=backlight_v_f)
 
     def clear(self):
         self._write_cmd(CLEAR_DISPLAY_CMD)
+        time.sleep(0.002)
+        self._addr = 0
 
     def set_display(self, on=True, blink=False, cursor=False):
         cmd = DISPLAY_CONTROL_CMD
@@ -192,23 +175,28 @@ class LCD:
         self._shift = shift
 
     def return_home(self):
-        self.write_cmd(RETURN_HOME_CMD)
+        self._write_cmd(RETURN_HOME_CMD)
         time.sleep(0.002)
+        self._addr = 0
 
     def set_ddram_addr(self, addr):
         cmd = SET_DDRAM_ADDR_CMD | (addr & DDRAM_ADDR_MASK)
         self._write_cmd(cmd)
+        self._addr = addr & DDRAM_ADDR_MASK
 
     def set_cgram_addr(self, addr):
         cmd = SET_CGRAM_ADDR_CMD | (addr & CGRAM_ADDR_MASK)
         self._write_cmd(cmd)
+        self._addr = None
 
     def write(self, line, column, string):
         if line not in (0, 1):
             raise ValueError("Line must be 0 or 1")
         if column < 0 or column >= 0x40:
             raise ValueError("Wrong column")
-        self.set_ddram_addr(0x40 * line + column)
+        addr = 0x40 * line + column
+        if addr != self._addr:
+            self.set_ddram_addr(addr)
         if not self._increment:
             self.set_entry_mode(True, self._shift)
         self.write_bytes(string[:0x40 - column])
@@ -224,3 +212,4 @@ if __name__ == "__main__":
     input()
     lcd.clear()
     lcd.set_backlight(False)
+    lcd.close()
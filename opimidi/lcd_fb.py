@@ -0,0 +1,125 @@
+"""Shadow framebuffer in front of the LCD.
+
+Only the cells that differ from what the display already shows are sent,
+and all writes issued within one event loop iteration are sent together.
+"""
+
+import asyncio
+import logging
+
+from .lcd_chars import LCD_CHARS
+
+logger = logging.getLogger("lcd_fb")
+
+# a DDRAM address jump costs as much as writing a single cell
+MAX_GAP = 1
+
+def _encode(string):
+    if isinstance(string, bytes):
+        return string
+    return string.encode("latin-1", "replace")
+
+class FramebufferLCD:
+    def __init__(self, lcd, loop=None):
+        self.lcd = lcd
+        self.lines = lcd.lines
+        self.width = lcd.width
+        if loop is None:
+            loop = asyncio.get_event_loop()
+        self.loop = loop
+        # what we want on the screen
+        self._target = [bytearray(b" " * self.width)
+                        for _ in range(self.lines)]
+        # what the screen shows, None when unknown
+        self._shown = [[None] * self.width for _ in range(self.lines)]
+        # CGRAM contents, None when unknown
+        self._cgram = None
+        self._flush_handle = None
+        if hasattr(lcd, "on_drop"):
+            lcd.on_drop = self._write_dropped
+        self.lcd.set_entry_mode(True, False)
+
+    def write(self, line, column, string):
+        if line not in range(self.lines):
+            raise ValueError("Line must be 0 or 1")
+        if column < 0 or column >= 0x40:
+            raise ValueError("Wrong column")
+        data = _encode(string)[:max(self.width - column, 0)]
+        self._target[line][column:column + len(data)] = data
+        self._schedule_flush()
+
+    def clear(self):
+        for line in self._target:
+            line[:] = b" " * self.width
+        self._schedule_flush()
+
+    def define_user_chars(self):
+        cgram = [bytes(ch_bytes) for ch_bytes in LCD_CHARS]
+        if cgram == self._cgram:
+            return
+        self.flush()
+        self.lcd.define_user_chars()
+        self._cgram = cgram
+
+    def set_backlight(self, on=True):
+        self.lcd.set_backlight(on)
+
+    def set_display(self, on=True, blink=False, cursor=False):
+        self.lcd.set_display(on, blink, cursor)
+
+    def get_write_files(self):
+        return self.lcd.get_write_files()
+
+    def close(self):
+        self.flush()
+        self.lcd.close()
+
+    def invalidate(self):
+        """Forget the display state, so everything is redrawn."""
+        self._shown = [[None] * self.width for _ in range(self.lines)]
+        self._schedule_flush()
+
+    def _write_dropped(self, line, column, string):
+        """Redraw cells of a write the LCD did not make."""
+        shown = self._shown[line]
+        end = min(column + len(string), self.width)
+        shown[column:end] = [None] * max(end - column, 0)
+        self._schedule_flush()
+
+    def _schedule_flush(self):
+        if self._flush_handle:
+            return
+        if not self.loop.is_running():
+            self.flush()
+            return
+        self._flush_handle = self.loop.call_soon(self.flush)
+
+    def _runs(self, line):
+        """Find (start, end) ranges of changed cells of a line."""
+        target = self._target[line]
+        shown = self._shown[line]
+        runs = []
+        for col in range(self.width):
+            if target[col] == shown[col]:
+                continue
+            if runs and col - runs[-1][1] <= MAX_GAP:
+                runs[-1][1] = col + 1
+            else:
+                runs.append([col, col + 1])
+        return runs
+
+    def flush(self):
+        """Send the changes to the LCD now."""
+        if self._flush_handle:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        for line in range(self.lines):
+            target = self._target[line]
+            shown = self._shown[line]
+            for start, end in self._runs(line):
+                data = bytes(target[start:end])
+                logger.debug("line %i, cells %i-%i: %r",
+                             line, start, end - 1, data)
+                # the LCD skips the address jump when already there
+                self.lcd.write(line, start, data)
+                shown[start:end] = data
@@ -0,0 +1,372 @@
+"""Transports driving the PCF8574 lines the LCD is connected to.
+
+Each transport takes 'images' of the PCF8574 output port – a byte with
+one bit per line, laid out as in `GPIO_LINES` – and makes the lines
+match it.
+"""
+
+import fcntl
+import glob
+import logging
+import os
+import struct
+
+from . import devices
+
+logger = logging.getLogger("lcd_io")
+
+GPIO_LABEL = "pcf8574"
+
+# the PCF8574 backpack on /dev/i2c-N, used by I2CBackpack
+I2C_BUS = 0
+I2C_ADDRESS = 0x3f
+BACKLIGHT_BIT = 3
+
+# <linux/i2c-dev.h>
+I2C_SLAVE = 0x0703
+I2C_SLAVE_FORCE = 0x0706
+
+GPIO_LINES = {
+        "RS": 0,
+        "RW": 1,
+        "E": 2,
+        # BL (3) is handled by gpio-leds interface
+        "DB4": 4,
+        "DB5": 5,
+        "DB6": 6,
+        "DB7": 7,
+        }
+
+# <linux/gpio.h> character device ABI (v1)
+GPIOHANDLES_MAX = 64
+GPIOHANDLE_REQUEST_OUTPUT = 1 << 1
+GPIOCHIP_INFO_FMT = "32s32sI"
+GPIOHANDLE_REQUEST_FMT = "{0}II{0}B32sIi".format(GPIOHANDLES_MAX)
+
+def _ioc(direction, nr, size):
+    return (direction << 30) | (size << 16) | (0xB4 << 8) | nr
+
+GPIO_GET_CHIPINFO_IOCTL = _ioc(2, 0x01, struct.calcsize(GPIOCHIP_INFO_FMT))
+GPIO_GET_LINEHANDLE_IOCTL = _ioc(3, 0x03,
+                                 struct.calcsize(GPIOHANDLE_REQUEST_FMT))
+GPIOHANDLE_SET_LINE_VALUES_IOCTL = _ioc(3, 0x09, GPIOHANDLES_MAX)
+
+class LCDIO:
+    """Base class of the LCD line transports."""
+    # True when writing a single image takes longer than the LCD needs to
+    # execute a command (~40µs), so no extra delays are needed
+    self_paced = False
+
+    def write(self, image):
+        """Set all the lines according to `image`."""
+        raise NotImplementedError
+
+    def write_many(self, images):
+        """Write a sequence of images, as fast as the transport allows."""
+        for image in images:
+            self.write(image)
+
+    def set_backlight(self, on):
+        """Switch the backlight, if controlled by the transport.
+
+        Return False if it is not and the LED interface should be used."""
+        return False
+
+    def get_write_files(self):
+        return []
+
+    def close(self):
+        pass
+
+class SysfsGPIO(LCDIO):
+    """Lines exported via the (deprecated) /sys/class/gpio interface."""
+    def __init__(self):
+        self._gpio_v_files = {}
+        self._gpio_v_fds = {}
+        # last value written to each line, None when unknown
+        self._gpio_state = dict.fromkeys(GPIO_LINES)
+        self._find_gpio()
+
+    def _find_gpio(self):
+        gpiochip_path = devices.lookup("sysfs_gpio", GPIO_LABEL)
+        if not gpiochip_path:
+            for gpiochip_path in glob.glob("/sys/class/gpio/gpiochip*"):
+                label_fn = os.path.join(gpiochip_path, "label")
+                with open(label_fn, "rt") as label_f:
+                    label = label_f.readline().strip()
+                    logger.debug("%r is %r", os.path.basename(gpiochip_path), label)
+                    if label == GPIO_LABEL:
+                        devices.remember("sysfs_gpio", GPIO_LABEL, gpiochip_path)
+                        break
+            else:
+                raise FileNotFoundError("Could not find GPIO chip {!r}".format(GPIO_LABEL))
+
+        self.chip_path = gpiochip_path
+        base_fn = os.path.join(gpiochip_path, "base")
+        with open(base_fn, "rt") as base_f:
+            base = int(base_f.readline().strip())
+
+        for name, bit in GPIO_LINES.items():
+            gpio_num = base + bit
+            logger.debug("%s is GPIO#%i", name, gpio_num)
+            bit_path = "/sys/class/gpio/gpio{}".format(gpio_num)
+            if not os.path.isdir(bit_path):
+                logger.debug("Exporting GPIO#%i", gpio_num)
+                with open("/sys/class/gpio/export", "wt") as export_f:
+                    print(gpio_num, file=export_f)
+            direction_fn = os.path.join(bit_path, "direction")
+            # check if direction is already ok, as we may have no permission
+            # to write there
+            with open(direction_fn, "rt") as direction_f:
+                direction = direction_f.readline().strip()
+            if direction != "out":
+                logger.debug("Setting GPIO#%i direction to 'out'", gpio_num)
+                with open(direction_fn, "wt") as direction_f:
+                    print("out", file=direction_f)
+            value_fn = os.path.join(bit_path, "value")
+            self._gpio_v_files[name] = value_fn
+            self._gpio_v_fds[name] = os.open(value_fn, os.O_WRONLY)
+
+    def close(self):
+        for fd in self._gpio_v_fds.values():
+            os.close(fd)
+        self._gpio_v_fds = {}
+        self._gpio_state = dict.fromkeys(GPIO_LINES)
+
+    def _set_bit(self, name, value):
+        if self._gpio_state[name] == value:
+            # line already in that state, save the I2C round-trip
+            return
+        os.pwrite(self._gpio_v_fds[name], b"1" if value else b"0", 0)
+        self._gpio_state[name] = value
+
+    def write(self, image):
+        # data and RS/RW first, so E changes after they are stable
+        for name, bit in GPIO_LINES.items():
+            if name != "E":
+                self._set_bit(name, (image >> bit) & 1)
+        self._set_bit("E", (image >> GPIO_LINES["E"]) & 1)
+
+    def get_write_files(self):
+        return list(self._gpio_v_files.values())
+
+class GPIOChip(LCDIO):
+    """All the lines requested as one handle via /dev/gpiochipN."""
+    def __init__(self, path=None):
+        self.path = None
+        self._line_fd = None
+        self._bits = list(GPIO_LINES.values())
+        self._data = bytearray(GPIOHANDLES_MAX)
+        if path:
+            self._request_lines(path)
+        else:
+            self._find_chip()
+
+    @staticmethod
+    def _chip_label(path):
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            info = bytearray(struct.calcsize(GPIOCHIP_INFO_FMT))
+            fcntl.ioctl(fd, GPIO_GET_CHIPINFO_IOCTL, info, True)
+        finally:
+            os.close(fd)
+        _, label, _ = struct.unpack(GPIOCHIP_INFO_FMT, info)
+        return label.rstrip(b"\x00").decode("utf-8", "replace")
+
+    def _find_chip(self):
+        path = devices.lookup("gpiochip", GPIO_LABEL)
+        if path:
+            try:
+                label = self._chip_label(path)
+            except OSError as err:
+                logger.debug("%r: %s", path, err)
+                label = None
+            if label == GPIO_LABEL:
+                self._request_lines(path)
+                return
+        for path in sorted(glob.glob("/dev/gpiochip*")):
+            try:
+                label = self._chip_label(path)
+            except OSError as err:
+                logger.debug("%r: %s", path, err)
+                continue
+            logger.debug("%r is %r", path, label)
+            if label == GPIO_LABEL:
+                self._request_lines(path)
+                devices.remember("gpiochip", GPIO_LABEL, path)
+                return
+        raise FileNotFoundError("Could not find GPIO chip {!r}".format(GPIO_LABEL))
+
+    def _request_lines(self, path):
+        offsets = self._bits + [0] * (GPIOHANDLES_MAX - len(self._bits))
+        defaults = [0] * GPIOHANDLES_MAX
+        request = bytearray(struct.pack(GPIOHANDLE_REQUEST_FMT,
+                                        *offsets,
+                                        GPIOHANDLE_REQUEST_OUTPUT,
+                                        *defaults,
+                                        b"opimidi-lcd",
+                                        len(self._bits),
+                                        -1))
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            fcntl.ioctl(fd, GPIO_GET_LINEHANDLE_IOCTL, request, True)
+        finally:
+            os.close(fd)
+        self._line_fd = struct.unpack(GPIOHANDLE_REQUEST_FMT, request)[-1]
+        self.path = path
+        logger.debug("Got line handle for %r on %r", GPIO_LINES, path)
+
+    def write(self, image):
+        data = self._data
+        for i, bit in enumerate(self._bits):
+            data[i] = (image >> bit) & 1
+        fcntl.ioctl(self._line_fd, GPIOHANDLE_SET_LINE_VALUES_IOCTL, data)
+
+    def get_write_files(self):
+        return [self.path]
+
+    def close(self):
+        if self._line_fd is not None:
+            os.close(self._line_fd)
+            self._line_fd = None
+
+class I2CBackpack(LCDIO):
+    """The PCF8574 written directly via /dev/i2c-N.
+
+    Every image is a single byte on the bus and a burst of images goes
+    out as one I2C write. As this bypasses the kernel GPIO driver,
+    the backlight bit is controlled here too.
+
+    `device` may be a file-like object to use instead of the I2C device.
+    """
+    self_paced = True
+
+    def __init__(self, bus=I2C_BUS, address=I2C_ADDRESS, device=None,
+                 force=True):
+        self.path = None
+        self._backlight = 0
+        self._image = 0
+        if device is not None:
+            self._dev = device
+            return
+        path = "/dev/i2c-{}".format(bus)
+        fd = os.open(path, os.O_RDWR)
+        try:
+            # the address is normally claimed by the gpio-pcf857x driver
+            fcntl.ioctl(fd, I2C_SLAVE_FORCE if force else I2C_SLAVE, address)
+        except OSError:
+            os.close(fd)
+            raise
+        self._dev = open(fd, "wb", buffering=0)
+        self.path = path
+        logger.debug("Using I2C device 0x%02x on %r", address, path)
+
+    def write(self, image):
+        self._dev.write(bytes((image | self._backlight,)))
+        self._image = image
+
+    def write_many(self, images):
+        backlight = self._backlight
+        self._dev.write(bytes(image | backlight for image in images))
+        if images:
+            self._image = images[-1]
+
+    def set_backlight(self, on):
+        self._backlight = (1 << BACKLIGHT_BIT) if on else 0
+        self.write(self._image)
+        return True
+
+    def get_write_files(self):
+        if self.path:
+            return [self.path]
+        return []
+
+    def close(self):
+        if self._dev is not None:
+            self._dev.close()
+            self._dev = None
+
+def decode_nibbles(images):
+    """(RS, value) of each nibble latched by an E falling edge."""
+    result = []
+    e_bit = 1 << GPIO_LINES["E"]
+    prev = 0
+    for image in images:
+        if (prev & e_bit) and not (image & e_bit):
+            rs = (prev >> GPIO_LINES["RS"]) & 1
+            result.append((rs, (prev >> GPIO_LINES["DB4"]) & 0x0f))
+        prev = image
+    return result
+
+class FakeGPIOChip(LCDIO):
+    """Stand-in for the GPIO chip, for use without the hardware.
+
+    Records all images written in `writes`."""
+    def __init__(self):
+        self.writes = []
+        self.image = 0
+
+    def write(self, image):
+        self.writes.append(image)
+        self.image = image
+
+    def nibbles(self):
+        return decode_nibbles(self.writes)
+
+class FakeI2CDevice:
+    """In-memory stand-in for /dev/i2c-N, to be passed to I2CBackpack.
+
+    Records the bytes of every I2C write in `transactions`."""
+    def __init__(self):
+        self.transactions = []
+
+    def write(self, data):
+        self.transactions.append(bytes(data))
+        return len(data)
+
+    def close(self):
+        pass
+
+    def images(self):
+        return [byte for data in self.transactions for byte in data]
+
+    def nibbles(self):
+        return decode_nibbles(self.images())
+
+def _chosen_kind():
+    """GPIO interface found usable before (by the root permission tool at
+    boot), None if not known."""
+    for kind in ("gpiochip", "sysfs"):
+        if devices.lookup("lcd_io", kind):
+            return kind
+    return None
+
+def open_lcd_io(kind=None):
+    """Find the best available transport for the LCD lines.
+
+    `kind` may be "i2c", "gpiochip" or "sysfs" to select one explicitly,
+    otherwise $OPIMIDI_LCD_IO is checked, then the GPIO interface chosen
+    before and then the GPIO interfaces are tried. The choice is
+    remembered, so the service uses the interface the permission tool
+    prepared."""
+    if kind is None:
+        kind = os.environ.get("OPIMIDI_LCD_IO") or _chosen_kind()
+    if kind == "i2c":
+        return I2CBackpack()
+    elif kind == "gpiochip":
+        return GPIOChip()
+    elif kind == "sysfs":
+        return SysfsGPIO()
+    elif kind:
+        raise ValueError("Unknown LCD transport: {!r}".format(kind))
+    try:
+        io = GPIOChip()
+    except OSError as err:
+        logger.debug("GPIO character device not usable: %s", err)
+    else:
+        devices.remember("lcd_io", "gpiochip", io.path)
+        return io
+    logger.debug("Falling back to the sysfs GPIO interface")
+    io = SysfsGPIO()
+    devices.remember("lcd_io", "sysfs", io.chip_path)
+    return io
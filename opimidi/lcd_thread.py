@@ -0,0 +1,217 @@
+"""LCD access from a dedicated thread.
+
+The LCD protocol needs many short sleeps and, depending on the
+transport, slow I2C transfers. ThreadedLCD queues the commands and runs
+them in a worker thread, so the asyncio loop is never blocked by them.
+"""
+
+import asyncio
+import collections
+import itertools
+import logging
+import threading
+
+from .util import abort
+
+logger = logging.getLogger("lcd_thread")
+
+QUEUE_SIZE = 32
+
+class _Command:
+    __slots__ = ("method", "args", "futures")
+    def __init__(self, method, args, futures):
+        self.method = method
+        self.args = args
+        self.futures = futures
+
+class ThreadedLCD:
+    """Asynchronous facade to an LCD object.
+
+    All methods queue the command and return immediately with an asyncio
+    future completed when the command has been executed. Errors are
+    logged and the future gets None as the result.
+
+    A queued write is superseded by a newer write to the same region:
+    it is dropped and its future completes together with the new one.
+    The caller is never blocked: when the queue is full the oldest
+    write is dropped, with its future completed, and `on_drop` is
+    called with its (line, column, string) once the worker thread made
+    progress, so the cells can be redrawn.
+    Other commands are never dropped.
+
+    `lcd` may also be a callable (like the LCD class) creating the LCD
+    object. It is then called in the worker thread, so the slow display
+    initialization goes on in parallel with the rest of the startup.
+    If that fails, the application is stopped and the next calls raise
+    RuntimeError.
+    """
+    def __init__(self, lcd, loop=None, maxsize=QUEUE_SIZE):
+        if callable(lcd):
+            self._factory = lcd
+            self.lcd = None
+        else:
+            self._factory = None
+            self.lcd = lcd
+        self.lines = lcd.lines
+        self.width = lcd.width
+        if loop is None:
+            loop = asyncio.get_event_loop()
+        self.loop = loop
+        self.maxsize = maxsize
+        self.dropped = 0
+        # called with (line, column, string) of a write dropped
+        self.on_drop = None
+        # args of the writes dropped since the last command executed
+        self._drops = []
+        # key -> _Command, in execution order
+        self._queue = collections.OrderedDict()
+        self._cond = threading.Condition()
+        self._keys = itertools.count()
+        self._closing = False
+        self._ready = threading.Event()
+        # exception raised by the LCD factory
+        self._error = None
+        self._thread = threading.Thread(target=self._run, name="lcd",
+                                        daemon=True)
+        self._thread.start()
+
+    def submit(self, method, *args, key=None):
+        """Queue `method` of the LCD object to be called with `args`.
+
+        A queued command with the same `key` will be dropped."""
+        future = self.loop.create_future()
+        with self._cond:
+            if self._error is not None:
+                raise RuntimeError("LCD initialization failed: {}"
+                                   .format(self._error))
+            if self._closing:
+                raise RuntimeError("LCD closed")
+            old = None
+            if key is not None:
+                old = self._queue.pop(key, None)
+            if old is not None:
+                logger.debug("dropping superseded %s%r", old.method, old.args)
+                self.dropped += 1
+                futures = old.futures + [future]
+            else:
+                if len(self._queue) >= self.maxsize:
+                    self._drop_oldest_write()
+                futures = [future]
+                if key is None:
+                    key = next(self._keys)
+            self._queue[key] = _Command(method, args, futures)
+            self._cond.notify_all()
+        return future
+
+    def _report_drops(self, drops):
+        if self.on_drop is None or self._closing or self._error is not None:
+            return
+        for args in drops:
+            self.on_drop(*args)
+
+    def _drop_oldest_write(self):
+        """Make room in the full queue, called with the lock held.
+
+        Only writes are dropped, other commands change the display state
+        and are kept, even above `maxsize`."""
+        for key in self._queue:
+            if isinstance(key, tuple) and key[0] == "write":
+                break
+        else:
+            logger.debug("LCD queue full of state changes, growing it")
+            return
+        command = self._queue.pop(key)
+        logger.warning("LCD queue full, dropping %s%r",
+                       command.method, command.args)
+        self.dropped += 1
+        self._drops.append(command.args)
+        self._complete(command.futures)
+
+    def write(self, line, column, string):
+        key = ("write", line, column, len(string))
+        return self.submit("write", line, column, string, key=key)
+
+    def write_bytes(self, string):
+        return self.submit("write_bytes", string)
+
+    def clear(self):
+        return self.submit("clear")
+
+    def define_user_chars(self):
+        return self.submit("define_user_chars")
+
+    def set_backlight(self, on=True):
+        return self.submit("set_backlight", on, key="set_backlight")
+
+    def set_display(self, on=True, blink=False, cursor=False):
+        return self.submit("set_display", on, blink, cursor)
+
+    def set_entry_mode(self, increment=True, shift=False):
+        return self.submit("set_entry_mode", increment, shift)
+
+    def sync(self):
+        """Future completed when everything queued so far is done."""
+        return self.submit(None)
+
+    def get_write_files(self):
+        self.wait_ready()
+        if self._error is not None:
+            raise RuntimeError("LCD initialization failed: {}"
+                               .format(self._error))
+        return self.lcd.get_write_files()
+
+    def wait_ready(self):
+        """Block until the LCD object is created."""
+        self._ready.wait()
+
+    def close(self):
+        """Execute the queued commands, stop the thread and close the LCD."""
+        with self._cond:
+            self._closing = True
+            self._cond.notify_all()
+        self._thread.join()
+        if self.lcd is not None:
+            self.lcd.close()
+
+    def _run(self):
+        if self._factory is not None:
+            try:
+                self.lcd = self._factory()
+            except Exception as err:
+                logger.exception("Could not initialize the LCD")
+                with self._cond:
+                    self._error = err
+                try:
+                    self.loop.call_soon_threadsafe(abort)
+                except RuntimeError:
+                    # loop already closed
+                    pass
+        self._ready.set()
+        while True:
+            with self._cond:
+                while not self._queue and not self._closing:
+                    self._cond.wait()
+                if not self._queue:
+                    return
+                _, command = self._queue.popitem(last=False)
+                drops, self._drops = self._drops, []
+            if command.method and self.lcd is not None:
+                try:
+                    getattr(self.lcd, command.method)(*command.args)
+                except Exception:
+                    logger.exception("LCD %s%r failed",
+                                     command.method, command.args)
+            try:
+                self.loop.call_soon_threadsafe(self._complete,
+                                               command.futures)
+                if drops:
+                    self.loop.call_soon_threadsafe(self._report_drops, drops)
+            except RuntimeError:
+                # loop already closed
+                pass
+
+    @staticmethod
+    def _complete(futures):
+        for future in futures:
+            if not future.done():
+                future.set_result(None)
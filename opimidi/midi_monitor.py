@@ -3,8 +3,7 @@ import asyncio
 import logging
 
 from .alsa import seq
-
-from .ops import eval_ops
+from .controls import ControllerState
 
 logger = logging.getLogger("midi_monitor")
 
@@ -19,37 +18,35 @@ MONITOR_SETTINGS = [
 
 BUTTON_MONITORS = {"A", "B"}
 
+# pedal input code -> monitor showing its position, when no controller
+# is monitored for it
+PEDAL_MONITORS = {0: "1", 1: "2"}
+
 class MIDIMonitor:
+    """Monitor the MIDI sent by the backend.
+
+    The backend publishes the controller values (and pedal positions)
+    over the UI connection, see `handle_midi_cc` and `handle_pedal`."""
     def __init__(self, ui):
         self.loop = asyncio.get_event_loop()
         self.ui = ui
 
-        # name -> controller number
+        # name -> (channel, controller number)
         self.monitors = {}
-        # controller number -> monitor
+        # (channel, controller number) -> monitor
         self.monitors_rev = {}
         # name -> 0-7 value
         self.monitor_values = {}
-        # controller number -> float value 
-        self.midi_controls = {}
+        # what the backend has sent
+        self.controls = ControllerState()
+        # pedal input code -> position (0.0 - 1.0)
+        self.pedal_values = {}
 
         self.pending_changes = {}
 
-        self.seq = seq.Client("opimidi_ui")
-        self.seq_port = self.seq.create_port("in",
-                                seq.PORT_CAP_WRITE | seq.PORT_CAP_SUBS_WRITE,
-                                seq.PORT_TYPE_MIDI_GENERIC)
-        try:
-            be_client, be_port = self.seq.parse_address("opimidi_be")
-            self.seq.connect_from(self.seq_port, be_client, be_port)
-        except (OSError, seq.SeqError) as err:
-            logger.debug("could not connect to opimidi_be: %s", err)
-
-        self.seq.asyncio_subscribe_events(self.loop, self.handle_midi_event)
-
     def set_program(self, program):
         logger.debug("Setting program to %r", program)
-        for handle in self.pending_changes.items():
+        for handle in self.pending_changes.values():
             handle.cancel()
         self.pending_changes = {}
         self.monitors = {}
@@ -57,11 +54,7 @@ class MIDIMonitor:
         all_monitors = set()
         for key, monitor in MONITOR_SETTINGS:
             all_monitors.add(monitor)
-            try:
-                ops_s = program[key]
-            except KeyError:
-                continue
-            ops = eval_ops(ops_s)
+            ops = program.get_ops(key)
             if not ops:
                 continue
             logger.debug("   monitor %r: %r", monitor, ops)
@@ -77,28 +70,28 @@ class MIDIMonitor:
             else:
                 logger.debug("        ...not something we can monitor")
                 continue
-            self.monitors[monitor] = event.param
-            self.monitors_rev[event.param] = monitor
-            logger.debug("   monitor %r: CC %r", monitor, event.param)
+            control = (event.channel, event.param)
+            self.monitors[monitor] = control
+            self.monitors_rev[control] = monitor
+            logger.debug("   monitor %r: CC %r", monitor, control)
         # load current values for all monitors
         for monitor in all_monitors:
-            try:
-                control = self.monitors[monitor]
-                value = self.midi_controls[control]
-            except KeyError:
-                value = None
+            value = None
+            control = self.monitors.get(monitor)
+            if control:
+                value = self.controls.get_cc(*control)
+                if value is not None:
+                    value /= 127.0
+            else:
+                for code, pedal_monitor in PEDAL_MONITORS.items():
+                    if pedal_monitor == monitor:
+                        value = self.pedal_values.get(code)
             self.set_monitor(monitor, value)
 
-    def handle_midi_event(self, event):
-        if isinstance(event, seq.ControlChangeEvent):
-            self.handle_midi_cc(event)
-        else:
-            logger.debug("Unknown event: %r", event)
-
-    def handle_midi_cc(self, event):
-        control = event.param
-        value = event.value / 127.0
-        self.midi_controls[control] = value
+    def handle_midi_cc(self, channel, param, value):
+        self.controls.set_cc(channel, param, value)
+        control = (channel, param)
+        value = value / 127.0
         monitor = self.monitors_rev.get(control)
         if not monitor:
             logger.debug("CC: %r=%r, not monitored", control, value)
@@ -106,6 +99,18 @@ class MIDIMonitor:
         logger.debug("CC: %r=%r updating monitor", control, value)
         self.set_monitor(monitor, value)
 
+    def handle_midi_program(self, channel, value):
+        self.controls.set_program(channel, value)
+
+    def handle_pedal(self, code, value):
+        """Pedal position (0.0 - 1.0), shown when the pedal ops have no
+        controller to monitor (e.g. NRPN)."""
+        value = min(max(value, 0.0), 1.0)
+        self.pedal_values[code] = value
+        monitor = PEDAL_MONITORS.get(code)
+        if monitor and monitor not in self.monitors:
+            self.set_monitor(monitor, value)
+
     def set_monitor(self, monitor, value):
         if value is None:
             mon_value = None
@@ -1,19 +1,35 @@
 
 from evdev import ecodes
 
+from array import array
+import asyncio
 import logging
+import time
 
 from .alsa import seq
 from .config import Config
+from .controls import ControllerState, CHANNELS, CONTROLLERS, UNKNOWN
 from .input import EventHandler, make_devices
 from .util import run_async_jobs
 from . import ops
-from .ops import eval_ops
 
 logger = logging.getLogger("midi_sender")
 
 MIDI_DEST = "f_midi"
 
+# maximum messages per second for a single controller, 0: no limit
+# (can be changed with 'max_cc_rate' in the [midi] config section)
+MAX_CC_RATE = 0
+
+# 'direct': send events immediately, 'queue': schedule them on an ALSA
+# queue at input timestamp + QUEUE_LATENCY, so processing delay
+# variations do not show in the output timing
+# ('output_mode' and 'queue_latency' in the [midi] config section)
+OUTPUT_MODE = "direct"
+QUEUE_LATENCY = 0.005
+# how often to check the queue clock against the input timestamps clock
+QUEUE_RESYNC_INTERVAL = 1.0
+
 INPUTS = {
         "button_A": (ecodes.EV_KEY, ecodes.BTN_0),
         "button_B": (ecodes.EV_KEY, ecodes.BTN_1),
@@ -28,11 +44,63 @@ DEMO_EVENT_MAP = {
         (ecodes.EV_ABS, 1): [ops.ControlChange(1),],
         }
 
+class DelayStats:
+    """Min/max/average of delays, in seconds."""
+    def __init__(self):
+        self.count = 0
+        self.min = None
+        self.max = None
+        self.sum = 0.0
+
+    def add(self, delay):
+        self.count += 1
+        self.sum += delay
+        if self.min is None or delay < self.min:
+            self.min = delay
+        if self.max is None or delay > self.max:
+            self.max = delay
+
+    def get_stats(self, prefix):
+        """'<prefix>_min/_max/_avg' and '<prefix>_jitter' (the spread)."""
+        if self.count:
+            avg = self.sum / self.count
+            jitter = self.max - self.min
+        else:
+            avg = jitter = None
+        return {
+                prefix + "_min": self.min,
+                prefix + "_max": self.max,
+                prefix + "_avg": avg,
+                prefix + "_jitter": jitter,
+                }
+
 class MIDISender(EventHandler):
     def __init__(self, config, event_map=None):
         self.config = config
         self.leave_ops = []
         self.program = None
+        # what we have sent (or scheduled to send) to the MIDI port
+        self.controls = ControllerState()
+        self.loop = asyncio.get_event_loop()
+        midi_settings = config.get_settings("midi")
+        max_cc_rate = float(midi_settings.get("max_cc_rate", MAX_CC_RATE))
+        self.min_cc_interval = 1.0 / max_cc_rate if max_cc_rate > 0 else 0
+        # per controller time and value of the last message actually sent
+        self._cc_sent_time = array("d", [0.0]) * (CHANNELS * CONTROLLERS)
+        self._cc_sent_value = array("h", [UNKNOWN]) * (CHANNELS * CONTROLLERS)
+        # controller index -> [event, input timestamp] to send at the end
+        # of the rate window
+        self._pending_cc = {}
+        self.sent_count = 0
+        self.suppressed_count = 0
+        self.coalesced_count = 0
+        # input event to _output() call
+        self.processing_delay = DelayStats()
+        # input event to the time the events are scheduled for
+        self.output_delay = DelayStats()
+        self.late_count = 0
+        # called with the list of events after every output
+        self.output_listeners = []
         if event_map:
             self.event_map = event_map
         else:
@@ -49,16 +117,182 @@ class MIDISender(EventHandler):
             self.seq.connect_to(self.port, dest_client, dest_port)
         except (OSError, seq.SeqError) as err:
             logger.error("could not connect to %s:%s: %s", dest_addr, dest_port, err)
+        self.queue = None
+        self._last_q_time = None
+        self.queue_latency = float(midi_settings.get("queue_latency",
+                                                     QUEUE_LATENCY))
+        output_mode = midi_settings.get("output_mode", OUTPUT_MODE)
+        if output_mode == "queue":
+            self._start_queue()
+        elif output_mode != "direct":
+            logger.error("Unknown output mode: %r", output_mode)
+
+    def _start_queue(self):
+        try:
+            self.queue = self.seq.create_queue("opimidi")
+            self.seq.start_queue(self.queue)
+            self.seq.drain_output()
+            self._sync_queue()
+        except (OSError, seq.SeqError) as err:
+            logger.error("could not set up the ALSA queue, sending directly:"
+                         " %s", err)
+            self.queue = None
+            return
+        logger.debug("Scheduling output on queue %i, latency %.1f ms",
+                     self.queue, self.queue_latency * 1000)
+
+    def _sync_queue(self):
+        """Find the offset between the input timestamps and the queue time."""
+        _, sec, nsec = self.seq.get_queue_time(self.queue)
+        now = time.time()
+        self._queue_offset = now - (sec + nsec * 0.000000001)
+        self._queue_sync_time = now
+        if self._last_q_time is None:
+            self._last_q_time = 0.0
+
+    def _output(self, events, timestamp=None):
+        """Send events now or schedule them on the queue.
+
+        `timestamp` is the time.time() of the input event causing them,
+        None for output not caused by an input event, not measured."""
+        now = time.time()
+        measured = timestamp is not None
+        if not measured:
+            timestamp = now
+        delay = now - timestamp
+        if measured:
+            self.processing_delay.add(delay)
+        if self.queue is None:
+            self.seq.event_output_many(events, port=self.port)
+            if measured:
+                self.output_delay.add(delay)
+        else:
+            if now - self._queue_sync_time > QUEUE_RESYNC_INTERVAL:
+                self._sync_queue()
+            if delay > self.queue_latency:
+                # too late, goes out as soon as possible
+                self.late_count += 1
+            # never before anything already scheduled, so the order of
+            # the events is kept
+            q_time = max(timestamp + self.queue_latency - self._queue_offset,
+                         self._last_q_time)
+            self._last_q_time = q_time
+            sec = int(q_time)
+            nsec = int((q_time - sec) * 1000000000)
+            self.seq.event_output_many(events, port=self.port,
+                                       queue=self.queue,
+                                       realtime=(sec, nsec))
+            if measured:
+                self.output_delay.add(max(q_time + self._queue_offset, now)
+                                      - timestamp)
+        self.sent_count += len(events)
+        for listener in self.output_listeners:
+            listener(events)
+
+    def apply_ops(self, ops, value=1.0, dedup=False, timestamp=None):
+        """Send MIDI messages of the ops.
 
-    def apply_ops(self, ops, value=1.0):
+        With `dedup` messages of single controller ops not changing the
+        value are dropped and the controller message rate is limited.
+        `timestamp` is the time of the input event."""
+        events = []
+        controls = self.controls
         for op in ops:
-            message = op.midi_message(value)
+            message = op.midi_message(value, controls)
             if not message:
                 continue
             logger.debug("  sending message: %r", message)
+            # multi-event messages (14-bit, NRPN) are sent as they are,
+            # the ops know which of their parts are needed
+            op_dedup = dedup and op.single_controller
             for event in message:
-                self.seq.event_output(event, port=self.port)
-            self.seq.drain_output()
+                if op_dedup and event.type == seq.EVENT_CONTROLLER:
+                    if controls.get_cc(event.channel, event.param) == event.value:
+                        self.suppressed_count += 1
+                        continue
+                    # next ops (e.g. a Toggle) must see the new values
+                    controls.update(event)
+                    if not self._cc_rate_check(event, timestamp):
+                        continue
+                else:
+                    controls.update(event)
+                    if event.type == seq.EVENT_CONTROLLER:
+                        self._cc_sent(event)
+                events.append(event)
+        if events:
+            # single buffer fill and drain for the whole op list
+            self._output(events, timestamp)
+
+    def _cc_sent(self, event):
+        index = event.channel * CONTROLLERS + event.param
+        # a pending older value must not follow
+        self._pending_cc.pop(index, None)
+        self._cc_sent_time[index] = self.loop.time()
+        self._cc_sent_value[index] = event.value
+
+    def _cc_rate_check(self, event, timestamp=None):
+        """Return True if the controller message may be sent now.
+
+        Otherwise the latest value is sent when the rate window is over,
+        with the `timestamp` of its input event."""
+        index = event.channel * CONTROLLERS + event.param
+        pending = self._pending_cc.get(index)
+        if pending is not None:
+            pending[0].value = event.value
+            pending[1] = timestamp
+            self.coalesced_count += 1
+            return False
+        now = self.loop.time()
+        if self.min_cc_interval:
+            wait = self._cc_sent_time[index] + self.min_cc_interval - now
+            if wait > 0:
+                # the op keeps reusing its event object, so copy it
+                self._pending_cc[index] = [seq.ControlChangeEvent(
+                        channel=event.channel, param=event.param,
+                        value=event.value), timestamp]
+                self.loop.call_later(wait, self._send_pending_cc, index)
+                self.coalesced_count += 1
+                return False
+        self._cc_sent_time[index] = now
+        self._cc_sent_value[index] = event.value
+        return True
+
+    def _send_pending_cc(self, index):
+        pending = self._pending_cc.pop(index, None)
+        if pending is None:
+            return
+        event, timestamp = pending
+        if event.value == self._cc_sent_value[index]:
+            # back where it was
+            self.suppressed_count += 1
+            return
+        self._cc_sent(event)
+        logger.debug("  sending coalesced message: %r", event)
+        try:
+            self._output([event], timestamp)
+        except (OSError, seq.SeqError) as err:
+            logger.error("Could not send MIDI event: %s", err)
+
+    def get_stats(self):
+        """MIDI output counters and timing (in seconds).
+
+        'processing_*' is the time from the input event to sending or
+        scheduling the output, its jitter is what the queue absorbs.
+        'output_*' is the time from the input event to the output time,
+        in queue mode 'latency' plus any lateness; its jitter is what
+        reaches the MIDI port. 'late' is the number of outputs that
+        could not be scheduled in time."""
+        stats = {
+                "sent": self.sent_count,
+                "suppressed": self.suppressed_count,
+                "coalesced": self.coalesced_count,
+                "mode": "direct" if self.queue is None else "queue",
+                "latency": 0.0 if self.queue is None else self.queue_latency,
+                "late": self.late_count,
+                }
+        stats.update(self.processing_delay.get_stats("processing"))
+        stats.update(self.output_delay.get_stats("output"))
+        return stats
 
     def handle_event(self, event):
         logger.debug("incoming event: %r", event)
@@ -67,42 +301,79 @@ class MIDISender(EventHandler):
             if not ops:
                 logger.debug("  no MIDI operators for that")
                 return
-            self.apply_ops(ops, event.value)
+            self.apply_ops(ops, event.value, dedup=True,
+                           timestamp=event.timestamp)
         except Exception as err:
             logger.error("Error while handling event: %s", err, exc_info=True)
 
     def set_program(self, bank_n, prog_n):
         logger.debug("Switching to program %s:%s", bank_n, prog_n)
         program = self.config.get_program(bank_n, prog_n)
+        # coalesced values of the old program's inputs must not follow
+        # its enter ops
+        self._pending_cc = {}
         self.leave_ops = []
-        if not self.program or program.bank != self.program.bank:
+        enter_ops = []
+        if not self.program or program.bank.name != self.program.bank.name:
             logger.debug("Switching bank")
-            if "enter" in program.bank:
-                enter_ops = eval_ops(program.bank["enter"])
-                self.apply_ops(enter_ops)
-            if "leave" in program.bank:
-                self.leave_ops = eval_ops(program.bank["leave"])
-        if "enter" in program:
-            enter_ops = eval_ops(program["enter"])
+            enter_ops += program.bank.get_ops("enter")
+            self.leave_ops = list(program.bank.get_ops("leave"))
+        enter_ops += program.get_ops("enter")
+        if enter_ops:
             self.apply_ops(enter_ops)
-        if "leave" in program:
-            self.leave_ops = eval_ops(program["leave"]) + self.leave_ops
+        self.leave_ops = list(program.get_ops("leave")) + self.leave_ops
         self.event_map = {}
         for key, event in INPUTS.items():
-            try:
-                ops_s = program[key]
-            except KeyError:
+            ops = program.get_ops(key)
+            if not ops:
                 continue
-            self.event_map[event] = eval_ops(ops_s)
+            for op in ops:
+                op.reset()
+            self.event_map[event] = ops
         logger.debug("Event map: %r", self.event_map)
         self.program = program
 
+    def set_config(self, config):
+        """Switch to a reloaded config.
+
+        The current program is applied again if it or its bank enter
+        ops have changed, changed leave ops are just swapped. If it is
+        gone, it stays active until another one is selected."""
+        self.config = config
+        current = self.program
+        if current is None:
+            return
+        bank_n, prog_n = current.bank.name, current.name
+        try:
+            program = config.get_program(bank_n, prog_n)
+        except KeyError:
+            logger.warning("Current program %s:%s not in the new config",
+                           bank_n, prog_n)
+            return
+        bank, current_bank = program.bank, current.bank
+        if bank.get_ops("enter") != current_bank.get_ops("enter"):
+            logger.info("Bank %s changed, applying it again", bank_n)
+            # so set_program() enters the bank again
+            self.program = None
+            self.set_program(bank_n, prog_n)
+        elif program.ops != current.ops:
+            logger.info("Program %s:%s changed, applying it again",
+                        bank_n, prog_n)
+            self.set_program(bank_n, prog_n)
+        else:
+            # same op objects, nothing to do
+            if bank.get_ops("leave") != current_bank.get_ops("leave"):
+                logger.debug("Bank %s leave ops changed", bank_n)
+                self.leave_ops = (list(program.get_ops("leave"))
+                                  + list(bank.get_ops("leave")))
+            self.program = program
+
 if __name__ == "__main__":
     logging.basicConfig(level=logging.DEBUG)
     config = Config()
     midi_sender = MIDISender(config, DEMO_EVENT_MAP)
     jobs = []
-    for device in make_devices():
+    for device in make_devices(config):
         jobs.append(device.collect_events(midi_sender))
     run_async_jobs(jobs)
 
@@ -1,73 +1,220 @@
 
+import functools
 import logging
+import re
 
 from .alsa import seq
 
 logger = logging.getLogger("ops")
 
 class ProgramOp:
-    def monitored_event(self, value):
-        """Event to monitor for this op."""
+    # True when every message is a single controller change, which may
+    # be dropped or delayed in favour of a later value
+    single_controller = False
+
+    def monitored_event(self):
+        """Event to monitor for this op, None if nothing to monitor."""
         return None
 
-    def current_value(self):
-        """Current value, if maintained, None otherwise."""
+    def current_value(self, state):
+        """Current value according to the ControllerState `state`,
+        None if unknown or not applicable."""
         return None
 
-    def midi_message(self, value):
+    def reset(self):
+        """Reset input state, when the op is (re)activated."""
+        pass
+
+    def midi_message(self, value, state):
         """MIDI message to send for this operator.
         
-        value is current value of the input (0.0 - 1.0)."""
+        value is current value of the input (0.0 - 1.0), state the
+        ControllerState of the output port (updated by the caller with
+        the events returned)."""
         raise NotImplementedError
 
-_CONTROL_VALUES = {}
+CC_DATA_ENTRY = 6
+
+def _channel(channel):
+    if channel < 1 or channel > 16:
+        raise ValueError("Invalid channel number")
+    return channel - 1
 
 class ControlChange(ProgramOp):
-    def __init__(self, number):
-        self.event = seq.ControlChangeEvent(param=number)
+    single_controller = True
+
+    def __init__(self, number, channel=1):
+        if (not isinstance(number, int) or isinstance(number, bool)
+                or number < 0 or number > 127):
+            raise ValueError("Invalid controller number")
+        self.event = seq.ControlChangeEvent(channel=_channel(channel),
+                                            param=number)
 
     def monitored_event(self):
         return self.event
 
-    def current_value(self):
-        return _CONTROL_VALUES.get(self.event.param)
+    def current_value(self, state):
+        value = state.get_cc(self.event.channel, self.event.param)
+        if value is None:
+            return None
+        return value / 127.0
 
-    def midi_message(self, value):
-        _CONTROL_VALUES[self.event.param] = value
+    def midi_message(self, value, state):
         # one byte precision
         midi_val = round(value * 127) & 0x7f
         self.event.value = midi_val
         return [self.event]
 
     def __repr__(self):
+        if self.event.channel:
+            return "ControlChange({!r}, channel={!r})".format(
+                    self.event.param, self.event.channel + 1)
         return "ControlChange({!r})".format(self.event.param)
 
+class ControlChange14(ProgramOp):
+    """14-bit controller: MSB on `number` (0-31), LSB on `number + 32`.
+
+    The MSB is only sent when it changes (receivers keep the LSB
+    then), the LSB always follows an MSB."""
+    def __init__(self, number, channel=1):
+        if number < 0 or number > 31:
+            raise ValueError("Invalid 14-bit controller number")
+        channel = _channel(channel)
+        self.channel = channel
+        self.number = number
+        self.msb_event = seq.ControlChangeEvent(channel=channel, param=number)
+        self.lsb_event = seq.ControlChangeEvent(channel=channel,
+                                                param=number + 32)
+
+    def monitored_event(self):
+        return self.msb_event
+
+    def current_value(self, state):
+        value = state.get_cc14(self.channel, self.number)
+        if value is None:
+            return None
+        return value / 16383.0
+
+    def midi_message(self, value, state):
+        midi_val = round(value * 16383) & 0x3fff
+        msb, lsb = midi_val >> 7, midi_val & 0x7f
+        self.lsb_event.value = lsb
+        if state.get_cc(self.channel, self.number) != msb:
+            self.msb_event.value = msb
+            return [self.msb_event, self.lsb_event]
+        elif state.get_cc(self.channel, self.number + 32) != lsb:
+            return [self.lsb_event]
+        return []
+
+    def __repr__(self):
+        if self.channel:
+            return "ControlChange14({!r}, channel={!r})".format(
+                    self.number, self.channel + 1)
+        return "ControlChange14({!r})".format(self.number)
+
+class NRPN(ProgramOp):
+    """Non-registered parameter (0-16383), with 14-bit value.
+
+    The parameter number is only sent when another one is selected and
+    the data entry MSB only when it changes."""
+    # parameter number MSB, LSB controllers
+    select_params = (99, 98)
+    registered = False
+
+    def __init__(self, parameter, channel=1):
+        if parameter < 0 or parameter > 16383:
+            raise ValueError("Invalid parameter number")
+        channel = _channel(channel)
+        self.channel = channel
+        self.parameter = parameter
+        msb_param, lsb_param = self.select_params
+        self.select_events = [
+                seq.ControlChangeEvent(channel=channel, param=msb_param,
+                                       value=parameter >> 7),
+                seq.ControlChangeEvent(channel=channel, param=lsb_param,
+                                       value=parameter & 0x7f),
+                ]
+        self.msb_event = seq.ControlChangeEvent(channel=channel,
+                                                param=CC_DATA_ENTRY)
+        self.lsb_event = seq.ControlChangeEvent(channel=channel,
+                                                param=CC_DATA_ENTRY + 32)
+
+    def monitored_event(self):
+        # the data entry controllers are shared by all the parameters,
+        # so their values say nothing about ours
+        return None
+
+    def _selected(self, state):
+        return (state.get_selected_parameter(self.channel)
+                == (self.registered, self.parameter))
+
+    def current_value(self, state):
+        if not self._selected(state):
+            return None
+        value = state.get_cc14(self.channel, CC_DATA_ENTRY)
+        if value is None:
+            return None
+        return value / 16383.0
+
+    def midi_message(self, value, state):
+        midi_val = round(value * 16383) & 0x3fff
+        msb, lsb = midi_val >> 7, midi_val & 0x7f
+        self.msb_event.value = msb
+        self.lsb_event.value = lsb
+        if not self._selected(state):
+            return self.select_events + [self.msb_event, self.lsb_event]
+        if state.get_cc(self.channel, CC_DATA_ENTRY) != msb:
+            return [self.msb_event, self.lsb_event]
+        elif state.get_cc(self.channel, CC_DATA_ENTRY + 32) != lsb:
+            return [self.lsb_event]
+        return []
+
+    def __repr__(self):
+        name = self.__class__.__name__
+        if self.channel:
+            return "{}({!r}, channel={!r})".format(name, self.parameter,
+                                                   self.channel + 1)
+        return "{}({!r})".format(name, self.parameter)
+
+class RPN(NRPN):
+    """Registered parameter (0-16383), with 14-bit value."""
+    select_params = (101, 100)
+    registered = True
+
 class BankSelect(ProgramOp):
-    def __init__(self, bank_number):
+    def __init__(self, bank_number, channel=1):
         if bank_number < 1 or bank_number > 16384:
-            raise ValueEror("Invalid bank number")
+            raise ValueError("Invalid bank number")
         midi_val = bank_number - 1
-        self.event = seq.ControlChange14btEvent(param=0, value=midi_val)
+        self.event = seq.ControlChange14bitEvent(channel=_channel(channel),
+                                                 param=0, value=midi_val)
 
     def monitored_event(self):
         return self.event
 
-    def midi_message(self, value):
+    def midi_message(self, value, state):
         if value > 0.5:
             return [self.event]
         else:
             return []
 
     def __repr__(self):
-        return "ControlChange({!r})".format(self.event.value + 1)
+        return "BankSelect({!r})".format(self.event.value + 1)
 
 class ProgramChange(ProgramOp):
-    def __init__(self, program_number):
+    def __init__(self, program_number, channel=1):
         if program_number < 1 or program_number > 128:
-            raise ValueEror("Invalid program number")
-        self.event = seq.ProgramChangeEvent(value=program_number-1)
+            raise ValueError("Invalid program number")
+        self.event = seq.ProgramChangeEvent(channel=_channel(channel),
+                                            value=program_number-1)
+
+    def current_value(self, state):
+        program = state.get_program(self.event.channel)
+        if program is None:
+            return None
+        return 1.0 if program == self.event.value else 0.0
 
-    def midi_message(self, value):
+    def midi_message(self, value, state):
         if value > 0.5:
             return [self.event]
         else:
@@ -86,9 +233,12 @@ class Toggle(ProgramOp):
         self.op = op
     def monitored_event(self):
         return self.op.monitored_event()
-    def current_value(self):
-        return self.op.current_value()
-    def midi_message(self, value):
+    def current_value(self, state):
+        return self.op.current_value(state)
+    def reset(self):
+        self.on = False
+        self.op.reset()
+    def midi_message(self, value, state):
         # input value hysteresis
         last_on = self.on
         if last_on and value < self.hist_low:
@@ -100,16 +250,16 @@ class Toggle(ProgramOp):
         else:
             # no change
             return []
-        prev_op_value = self.op.current_value()
+        prev_op_value = self.op.current_value(state)
         if prev_op_value is None:
             logger.debug("Setting %r on", self.op)
-            return self.op.midi_message(1.0)
+            return self.op.midi_message(1.0, state)
         elif prev_op_value > 0.5:
             logger.debug("Toggling %r off", self.op)
-            return self.op.midi_message(0.0)
+            return self.op.midi_message(0.0, state)
         else:
             logger.debug("Toggling %r on", self.op)
-            return self.op.midi_message(1.0)
+            return self.op.midi_message(1.0, state)
     def __repr__(self):
         return "Toggle({!r})".format(self.op)
 
@@ -121,29 +271,161 @@ class Set(ProgramOp):
         self.value = value
     def monitored_event(self):
         return self.op.monitored_event()
-    def current_value(self):
-        return self.op.current_value()
-    def midi_message(self, value):
+    def current_value(self, state):
+        return self.op.current_value(state)
+    def reset(self):
+        self.op.reset()
+    def midi_message(self, value, state):
         if value > 0.5:
-            return self.op.midi_message(self.value)
+            return self.op.midi_message(self.value, state)
         else:
             return []
     def __repr__(self):
         return "Set({!r},{!r})".format(self.op, self.value)
 
 
-OP_ALLOWED = ["ControlChange", "BankSelect", "ProgramChange", "Toggle", "Set"]
+OP_ALLOWED = ["ControlChange", "ControlChange14", "NRPN", "RPN",
+              "BankSelect", "ProgramChange", "Toggle", "Set"]
 OP_NAMESPACE = { k: v for k, v in globals().items() if k in OP_ALLOWED }
-OP_NAMESPACE["__builtins__"] = {}
+
+PARSE_CACHE_SIZE = 256
+
+_TOKEN_RE = re.compile(r"""
+          (?P<number>[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)
+        | (?P<name>[A-Za-z_]\w*)
+        | (?P<punct>[(),=])
+        """, re.VERBOSE)
+
+class OpSyntaxError(ValueError):
+    """Invalid op expression, `pos` is the offset of the problem."""
+    def __init__(self, message, string, pos):
+        self.message = message
+        self.string = string
+        self.pos = pos
+        super().__init__("{} at column {} of {!r}".format(message, pos + 1,
+                                                         string))
+
+def _tokenize(string):
+    tokens = []
+    pos = 0
+    length = len(string)
+    while True:
+        while pos < length and string[pos].isspace():
+            pos += 1
+        if pos >= length:
+            break
+        match = _TOKEN_RE.match(string, pos)
+        if not match:
+            raise OpSyntaxError("Unexpected character {!r}".format(string[pos]),
+                                string, pos)
+        tokens.append((match.lastgroup, match.group(), pos))
+        pos = match.end()
+    tokens.append(("end", None, pos))
+    return tokens
+
+class _Parser:
+    """Recursive descent parser of the op list grammar:
+
+        ops  := [ op { "," op } [ "," ] ]
+        op   := NAME "(" [ arg { "," arg } [ "," ] ] ")"
+        arg  := [ NAME "=" ] ( op | NUMBER )
+
+    The result is a tree of (name, args, kwargs, pos) tuples."""
+    def __init__(self, string):
+        self.string = string
+        self.tokens = _tokenize(string)
+        self.index = 0
+
+    def error(self, message, token=None):
+        if token is None:
+            token = self.tokens[self.index]
+        raise OpSyntaxError(message, self.string, token[2])
+
+    def peek(self, offset=0):
+        return self.tokens[min(self.index + offset, len(self.tokens) - 1)]
+
+    def next(self):
+        token = self.tokens[self.index]
+        self.index += 1
+        return token
+
+    def expect(self, value):
+        token = self.next()
+        if token[1] != value:
+            self.error("Expected {!r}".format(value), token)
+        return token
+
+    def parse(self):
+        ops = []
+        while self.peek()[0] != "end":
+            ops.append(self.op())
+            if self.peek()[1] == ",":
+                self.next()
+            elif self.peek()[0] != "end":
+                self.error("Expected ',' or end of expression")
+        return tuple(ops)
+
+    def op(self):
+        token = self.next()
+        if token[0] != "name":
+            self.error("Expected op name", token)
+        if token[1] not in OP_NAMESPACE:
+            self.error("Unknown op {!r}".format(token[1]), token)
+        self.expect("(")
+        args = []
+        kwargs = []
+        while self.peek()[1] != ")":
+            if self.peek()[0] == "name" and self.peek(1)[1] == "=":
+                key = self.next()[1]
+                self.next()
+                kwargs.append((key, self.arg()))
+            elif kwargs:
+                self.error("Positional argument after keyword argument")
+            else:
+                args.append(self.arg())
+            if self.peek()[1] == ",":
+                self.next()
+            elif self.peek()[1] != ")":
+                self.error("Expected ',' or ')'")
+        self.next()
+        return (token[1], tuple(args), tuple(kwargs), token[2])
+
+    def arg(self):
+        token = self.peek()
+        if token[0] == "number":
+            self.next()
+            if re.fullmatch(r"[-+]?\d+", token[1]):
+                return int(token[1])
+            return float(token[1])
+        elif token[0] == "name":
+            return self.op()
+        self.error("Expected number or op")
+
+@functools.lru_cache(maxsize=PARSE_CACHE_SIZE)
+def _parse(string):
+    return _Parser(string).parse()
+
+def _build(string, node):
+    name, args, kwargs, pos = node
+    args = [_build(string, a) if isinstance(a, tuple) else a for a in args]
+    kwargs = {k: _build(string, v) if isinstance(v, tuple) else v
+              for k, v in kwargs}
+    try:
+        return OP_NAMESPACE[name](*args, **kwargs)
+    except (TypeError, ValueError) as err:
+        raise OpSyntaxError("{}: {}".format(name, err), string, pos)
+
+def parse_ops(string):
+    """Parse op list expression, raise ValueError when invalid.
+
+    Parse trees are cached, but new op objects are built on every call,
+    as they keep state."""
+    tree = _parse(string)
+    return [_build(string, node) for node in tree]
 
 def eval_ops(string):
-    if "__" in string:
-        logger.error("Expression %r not allowed", string)
-        return []
-    expr = "[" +  string + "]"
-    logger.debug("Evaluating %r in %r", expr, OP_NAMESPACE)
     try:
-        return eval(expr, OP_NAMESPACE)
-    except Exception as err:
-        logger.error("Invalid expression %r: %s", string, err)
+        return parse_ops(string)
+    except ValueError as err:
+        logger.error("%s", err)
         return []
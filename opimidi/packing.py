@@ -0,0 +1,201 @@
+"""Compact binary serialization.
+
+A subset of the MessagePack format (https://msgpack.org/), enough for
+the values used in the backend/frontend protocol: None, booleans,
+integers, floats, strings, bytes, lists and dicts.
+"""
+
+import struct
+
+_uint8 = struct.Struct(">B")
+_uint16 = struct.Struct(">H")
+_uint32 = struct.Struct(">I")
+_int64 = struct.Struct(">q")
+_uint64 = struct.Struct(">Q")
+_float64 = struct.Struct(">d")
+
+def _pack(obj, out):
+    if obj is None:
+        out.append(0xc0)
+    elif obj is False:
+        out.append(0xc2)
+    elif obj is True:
+        out.append(0xc3)
+    elif isinstance(obj, int):
+        if 0 <= obj < 0x80:
+            out.append(obj)
+        elif -32 <= obj < 0:
+            out.append(obj & 0xff)
+        elif -2**63 <= obj < 0:
+            out.append(0xd3)
+            out += _int64.pack(obj)
+        elif obj < 2**64:
+            out.append(0xcf)
+            out += _uint64.pack(obj)
+        else:
+            raise ValueError("Integer too large: {!r}".format(obj))
+    elif isinstance(obj, float):
+        out.append(0xcb)
+        out += _float64.pack(obj)
+    elif isinstance(obj, str):
+        data = obj.encode("utf-8")
+        length = len(data)
+        if length < 32:
+            out.append(0xa0 | length)
+        elif length < 0x100:
+            out.append(0xd9)
+            out.append(length)
+        elif length < 0x10000:
+            out.append(0xda)
+            out += _uint16.pack(length)
+        else:
+            out.append(0xdb)
+            out += _uint32.pack(length)
+        out += data
+    elif isinstance(obj, (bytes, bytearray, memoryview)):
+        length = len(obj)
+        if length < 0x100:
+            out.append(0xc4)
+            out.append(length)
+        elif length < 0x10000:
+            out.append(0xc5)
+            out += _uint16.pack(length)
+        else:
+            out.append(0xc6)
+            out += _uint32.pack(length)
+        out += obj
+    elif isinstance(obj, (list, tuple)):
+        length = len(obj)
+        if length < 16:
+            out.append(0x90 | length)
+        elif length < 0x10000:
+            out.append(0xdc)
+            out += _uint16.pack(length)
+        else:
+            out.append(0xdd)
+            out += _uint32.pack(length)
+        for item in obj:
+            _pack(item, out)
+    elif isinstance(obj, dict):
+        length = len(obj)
+        if length < 16:
+            out.append(0x80 | length)
+        elif length < 0x10000:
+            out.append(0xde)
+            out += _uint16.pack(length)
+        else:
+            out.append(0xdf)
+            out += _uint32.pack(length)
+        for key, value in obj.items():
+            _pack(key, out)
+            _pack(value, out)
+    else:
+        raise TypeError("Cannot pack {!r}".format(type(obj).__name__))
+
+def pack(obj, out=None):
+    """Serialize `obj`, appending to `out` bytearray if given."""
+    if out is None:
+        out = bytearray()
+    _pack(obj, out)
+    return out
+
+def _unpack_seq(buf, offset, length):
+    items = []
+    for _ in range(length):
+        item, offset = unpack_from(buf, offset)
+        items.append(item)
+    return items, offset
+
+def _unpack_map(buf, offset, length):
+    result = {}
+    for _ in range(length):
+        key, offset = unpack_from(buf, offset)
+        value, offset = unpack_from(buf, offset)
+        result[key] = value
+    return result, offset
+
+def _bytes(buf, offset, length):
+    end = offset + length
+    if end > len(buf):
+        raise ValueError("Truncated data")
+    return bytes(buf[offset:end]), end
+
+def unpack_from(buf, offset=0):
+    """Deserialize a value from `buf` at `offset`.
+
+    Return the value and the offset after it. Raises ValueError on
+    invalid or truncated data."""
+    try:
+        code = buf[offset]
+        offset += 1
+        if code < 0x80:
+            return code, offset
+        elif code >= 0xe0:
+            return code - 0x100, offset
+        elif code & 0xe0 == 0xa0:
+            data, offset = _bytes(buf, offset, code & 0x1f)
+            return data.decode("utf-8"), offset
+        elif code & 0xf0 == 0x90:
+            return _unpack_seq(buf, offset, code & 0x0f)
+        elif code & 0xf0 == 0x80:
+            return _unpack_map(buf, offset, code & 0x0f)
+        elif code == 0xc0:
+            return None, offset
+        elif code == 0xc2:
+            return False, offset
+        elif code == 0xc3:
+            return True, offset
+        elif code == 0xcb:
+            return _float64.unpack_from(buf, offset)[0], offset + 8
+        elif code == 0xca:
+            return struct.unpack_from(">f", buf, offset)[0], offset + 4
+        elif code in _INT_FORMATS:
+            fmt = _INT_FORMATS[code]
+            return fmt.unpack_from(buf, offset)[0], offset + fmt.size
+        elif code in _LENGTH_FORMATS:
+            kind, fmt = _LENGTH_FORMATS[code]
+            length = fmt.unpack_from(buf, offset)[0]
+            offset += fmt.size
+            if kind == "str":
+                data, offset = _bytes(buf, offset, length)
+                return data.decode("utf-8"), offset
+            elif kind == "bin":
+                return _bytes(buf, offset, length)
+            elif kind == "array":
+                return _unpack_seq(buf, offset, length)
+            else:
+                return _unpack_map(buf, offset, length)
+    except (IndexError, struct.error, UnicodeDecodeError) as err:
+        raise ValueError("Invalid packed data: {}".format(err))
+    raise ValueError("Unsupported type code: 0x{:02x}".format(code))
+
+_INT_FORMATS = {
+        0xcc: _uint8,
+        0xcd: _uint16,
+        0xce: _uint32,
+        0xcf: _uint64,
+        0xd0: struct.Struct(">b"),
+        0xd1: struct.Struct(">h"),
+        0xd2: struct.Struct(">i"),
+        0xd3: _int64,
+        }
+
+_LENGTH_FORMATS = {
+        0xd9: ("str", _uint8),
+        0xda: ("str", _uint16),
+        0xdb: ("str", _uint32),
+        0xc4: ("bin", _uint8),
+        0xc5: ("bin", _uint16),
+        0xc6: ("bin", _uint32),
+        0xdc: ("array", _uint16),
+        0xdd: ("array", _uint32),
+        0xde: ("map", _uint16),
+        0xdf: ("map", _uint32),
+        }
+
+def unpack(data):
+    """Deserialize a single value filling the whole of `data`."""
+    obj, offset = unpack_from(data)
+    if offset != len(data):
+        raise ValueError("Extra data after packed value")
+    return obj
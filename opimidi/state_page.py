@@ -0,0 +1,191 @@
+"""Backend state published in a memory-mapped file.
+
+The backend keeps the current program, controller values, pedal
+positions and some counters in a small fixed-layout file under
+/run/opimidi, so the frontend and diagnostic tools can read them
+without asking the backend.
+
+Updates are protected by a sequence lock: the writer makes the
+sequence number odd while updating and even again when done; readers
+retry when the number is odd or changed while they were reading.
+
+Run `python3 -m opimidi.state_page` to dump the current state.
+"""
+
+import logging
+import mmap
+import os
+import struct
+import time
+
+from contextlib import contextmanager
+
+logger = logging.getLogger("state_page")
+
+STATE_DIR = os.environ.get("XDG_RUNTIME_DIR", "/run/opimidi")
+STATE_PATH = os.path.join(STATE_DIR, "state")
+
+MAGIC = b"OPMS"
+VERSION = 1
+
+CHANNELS = 16
+CONTROLLERS = 128
+PEDALS = 2
+COUNTERS = ["input_events", "midi_sent", "midi_suppressed",
+            "midi_coalesced", "midi_late"]
+
+NAME_SIZE = 32
+
+# magic, version, sequence
+HEADER = struct.Struct("<4sII")
+# update time, program number (increased on every program change),
+# bank name, program name
+PROGRAM = struct.Struct("<dI{0}s{0}s".format(NAME_SIZE))
+# raw and relative value of each pedal
+PEDAL = struct.Struct("<id")
+COUNTER = struct.Struct("<Q")
+
+PROGRAM_OFFSET = HEADER.size
+CC_OFFSET = PROGRAM_OFFSET + PROGRAM.size
+PEDALS_OFFSET = CC_OFFSET + CHANNELS * CONTROLLERS
+COUNTERS_OFFSET = PEDALS_OFFSET + PEDALS * PEDAL.size
+PAGE_SIZE = COUNTERS_OFFSET + len(COUNTERS) * COUNTER.size
+
+SEQ_OFFSET = 8
+SEQ = struct.Struct("<I")
+
+# reader retries before giving up on a busy writer
+READ_RETRIES = 1000
+
+def _name(string):
+    return string.encode("utf-8")[:NAME_SIZE]
+
+class StatePageWriter:
+    def __init__(self, path=STATE_PATH):
+        self.path = path
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            os.ftruncate(fd, PAGE_SIZE)
+            self._map = mmap.mmap(fd, PAGE_SIZE, mmap.MAP_SHARED,
+                                  mmap.PROT_READ | mmap.PROT_WRITE)
+        finally:
+            os.close(fd)
+        self._seq = 0
+        self._depth = 0
+        self._program_number = 0
+        self._counters = [0] * len(COUNTERS)
+        with self.update():
+            self._map[HEADER.size:] = bytes(PAGE_SIZE - HEADER.size)
+            # all controllers unknown
+            self._map[CC_OFFSET:PEDALS_OFFSET] = b"\xff" * (CHANNELS
+                                                            * CONTROLLERS)
+            for i in range(PEDALS):
+                PEDAL.pack_into(self._map, PEDALS_OFFSET + i * PEDAL.size,
+                                -1, -1.0)
+        HEADER.pack_into(self._map, 0, MAGIC, VERSION, self._seq)
+        logger.debug("State page at %r, %i bytes", path, PAGE_SIZE)
+
+    @contextmanager
+    def update(self):
+        """Group changes, so readers see them all or none."""
+        if not self._depth:
+            self._seq += 1
+            SEQ.pack_into(self._map, SEQ_OFFSET, self._seq)
+        self._depth += 1
+        try:
+            yield
+        finally:
+            self._depth -= 1
+            if not self._depth:
+                self._seq += 1
+                SEQ.pack_into(self._map, SEQ_OFFSET, self._seq)
+
+    def set_program(self, bank_name, program_name):
+        self._program_number += 1
+        with self.update():
+            PROGRAM.pack_into(self._map, PROGRAM_OFFSET, time.time(),
+                              self._program_number,
+                              _name(bank_name), _name(program_name))
+
+    def set_cc(self, channel, param, value):
+        with self.update():
+            self._map[CC_OFFSET + channel * CONTROLLERS + param] = value
+
+    def set_pedal(self, index, raw_value, value):
+        if index >= PEDALS:
+            return
+        with self.update():
+            PEDAL.pack_into(self._map, PEDALS_OFFSET + index * PEDAL.size,
+                            raw_value, value)
+
+    def set_counters(self, **counters):
+        with self.update():
+            for i, name in enumerate(COUNTERS):
+                if name in counters:
+                    COUNTER.pack_into(self._map,
+                                      COUNTERS_OFFSET + i * COUNTER.size,
+                                      counters[name])
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+class StatePageReader:
+    def __init__(self, path=STATE_PATH):
+        self.path = path
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            self._map = mmap.mmap(fd, PAGE_SIZE, mmap.MAP_SHARED,
+                                  mmap.PROT_READ)
+        finally:
+            os.close(fd)
+        magic, version, _ = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or version != VERSION:
+            self._map.close()
+            raise ValueError("{!r} is not a state page we know".format(path))
+
+    def read_raw(self):
+        """Consistent copy of the whole page."""
+        for _ in range(READ_RETRIES):
+            seq = SEQ.unpack_from(self._map, SEQ_OFFSET)[0]
+            if seq & 1:
+                continue
+            data = self._map[:]
+            if SEQ.unpack_from(self._map, SEQ_OFFSET)[0] == seq:
+                return data
+        raise BlockingIOError("State page busy")
+
+    def read(self):
+        """Current state as a dict."""
+        data = self.read_raw()
+        timestamp, number, bank, program = PROGRAM.unpack_from(data,
+                                                               PROGRAM_OFFSET)
+        cc = {}
+        for index in range(CHANNELS * CONTROLLERS):
+            value = data[CC_OFFSET + index]
+            if value != 0xff:
+                cc[index // CONTROLLERS, index % CONTROLLERS] = value
+        pedals = [PEDAL.unpack_from(data, PEDALS_OFFSET + i * PEDAL.size)
+                  for i in range(PEDALS)]
+        counters = {name: COUNTER.unpack_from(data, COUNTERS_OFFSET
+                                                    + i * COUNTER.size)[0]
+                    for i, name in enumerate(COUNTERS)}
+        return {
+                "program_time": timestamp,
+                "program_number": number,
+                "bank": bank.rstrip(b"\x00").decode("utf-8", "replace"),
+                "program": program.rstrip(b"\x00").decode("utf-8", "replace"),
+                "cc": cc,
+                "pedals": pedals,
+                "counters": counters,
+                }
+
+    def close(self):
+        self._map.close()
+
+if __name__ == "__main__":
+    import pprint
+    import sys
+    reader = StatePageReader(sys.argv[1] if len(sys.argv) > 1 else STATE_PATH)
+    pprint.pprint(reader.read())
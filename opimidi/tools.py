@@ -34,8 +34,10 @@ def opimidi_set_permissions():
     from .lcd import LCD
     from .input import get_write_files
 
-    lcd = LCD()
+    # no need to initialize the display
+    lcd = LCD(init=False)
     files_to_write = lcd.get_write_files() + get_write_files()
+    lcd.close()
     for path in files_to_write:
         logger.debug("chown %s:%s %s", uid, gid, path)
         os.chown(path, uid, gid)
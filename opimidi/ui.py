@@ -14,6 +14,8 @@ from evdev import ecodes
 from .util import run_async_jobs, abort
 from .input import EventHandler, make_devices
 from .lcd import LCD
+from .lcd_fb import FramebufferLCD
+from .lcd_thread import ThreadedLCD
 from .config import Config
 from .midi_monitor import MIDIMonitor
 
@@ -29,6 +31,9 @@ KEYS_BYNAME = {name: code for code, name in KEYS.items()}
 QUEUE_SIZE = 10
 HOLD_TIME = 1
 
+# max monitor updates per second requested from the backend
+MONITOR_MAX_RATE = 25
+
 IP_CMD = ["/sbin/ip", "-o", "-4", "addr", "show", "dev", "eth0"]
 IP_RE = re.compile(r"inet\s+([\d.]+)")
 
@@ -280,7 +285,7 @@ class ProgramMode(UIMode):
                 return DefaultMode(self.ui)
 
 class OpimidiUI(EventHandler):
-    def __init__(self, backend=None):
+    def __init__(self, backend=None, config=None):
         self.cur_bank_i = 0
         self.cur_prog_i = 0
         self.banks = []
@@ -290,11 +295,13 @@ class OpimidiUI(EventHandler):
         self.backend = backend
         if backend:
             backend.ui = self
+        self.mode = None
         self.monitors_enabled = False
         self.midi_monitor = MIDIMonitor(self)
         self._pressed = {}
-        self.config = Config()
-        self.lcd = LCD()
+        self.config = config if config is not None else Config()
+        # initialized in the LCD thread, while we go on
+        self.lcd = FramebufferLCD(ThreadedLCD(LCD))
         self.lcd.set_display(cursor=False, blink=False)
         self.lcd.define_user_chars()
         self.monitor_pos = {
@@ -330,6 +337,36 @@ class OpimidiUI(EventHandler):
                 ["set_program", self.bank.name, self.program.name],
                 ])
 
+    def reload_config(self, config=None):
+        """Switch to the new config, after the backend reloaded it.
+
+        The current program stays selected if it is still there."""
+        if config is None:
+            config = Config(self.config.path, self.config)
+        banks = [b for b in config.get_banks() if b.programs]
+        if not banks:
+            logger.error("No programs found in the new config")
+            return
+        self.config = config
+        self.banks = banks
+        bank_names = [bank.name for bank in banks]
+        if self.bank.name not in bank_names:
+            self.select_bank(0)
+        else:
+            self.cur_bank_i = bank_names.index(self.bank.name)
+            self.bank = banks[self.cur_bank_i]
+            self.programs = list(self.bank.programs.values())
+            prog_names = [program.name for program in self.programs]
+            if self.program.name not in prog_names:
+                self.select_program(0)
+            else:
+                # the backend keeps it selected
+                self.select_program(prog_names.index(self.program.name),
+                                    False)
+        if isinstance(self.mode, (DefaultMode, ProgramMode)):
+            # show the new names
+            self.mode.enter()
+
     def enable_monitors(self):
         if self.monitors_enabled:
             return
@@ -393,6 +430,9 @@ class OpimidiUI(EventHandler):
 
     def handle_event(self, event):
         logger.debug("incoming event: %r", event)
+        if event.type == ecodes.EV_ABS:
+            self.midi_monitor.handle_pedal(event.code, event.value)
+            return
         if event.type != ecodes.EV_KEY:
             return
 
@@ -433,15 +473,22 @@ class OpimidiUI(EventHandler):
 
     def subscribe_keys(self, keys):
         events = [(ecodes.EV_KEY, KEYS_BYNAME.get(name)) for name in keys]
+        # pedal positions for the monitors
+        tap_events = [(ecodes.EV_ABS, None)]
         self.backend.send_frame([
-            ["set_subscribed_events", events],
+            ["set_subscribed_events", events, tap_events],
             ])
 
     async def run(self):
         mode = StandByMode(self)
+        self.backend.send_frame([
+            ["set_update_rate", MONITOR_MAX_RATE],
+            ["subscribe_midi"],
+            ])
         try:
             while mode:
                 logger.debug("Entering %r", mode)
+                self.mode = mode
                 self.subscribe_keys(mode.keys_wanted)
                 mode.enter()
                 try:
@@ -458,6 +505,7 @@ class OpimidiUI(EventHandler):
         finally:
             self.lcd.set_backlight(False)
             self.lcd.clear()
+            self.lcd.close()
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.DEBUG)
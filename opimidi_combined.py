@@ -0,0 +1,5 @@
+#!/usr/bin/python3
+
+from opimidi.combined import main
+
+main()
@@ -67,6 +67,7 @@ setup(
         'console_scripts': [
             'opimidi_be = opimidi.backend:main',
             'opimidi_fe = opimidi.frontend:main',
+            'opimidi_combined = opimidi.combined:main',
             'opimidi_set_permissions = opimidi.tools:opimidi_set_permissions',
             'opimidi_start_usb = opimidi.usb:opimidi_start_usb',
             'opimidi_stop_usb = opimidi.usb:opimidi_stop_usb',